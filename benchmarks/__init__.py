@@ -0,0 +1,91 @@
+"""
+Benchmarks of the BLE protocol, run against the simulated firmware in
+`ble.simulator` so they can be reproduced on any machine:
+
+    python -m benchmarks
+    python -m benchmarks --mtu 247 --log-size 1048576 --json results.json
+"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from bleak.backends.device import BLEDevice
+
+from ble import Device, Scanner
+from ble.listings import ListingCache
+from ble.registry import KnownDevices
+from ble.simulator import LinkProfile, SimulatedBackend, SimulatedLogger
+
+BENCHMARKS: Dict[str, Callable] = {}
+
+
+def benchmark(name: str):
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return decorator
+
+
+async def wait_for(predicate: Callable[[], bool], timeout: float, interval: float = 0.001):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            raise TimeoutError()
+
+        await asyncio.sleep(interval)
+
+
+class Session:
+    """
+    Simulated loggers connected through `Device`, without scanning.
+
+        async with Session(options, count=2) as session:
+            for device in session.devices: ...
+    """
+
+    def __init__(self, options, count: int = 1, connect: bool = True, features=None, drop_after: int = 0,
+                 ignore_every: int = 0):
+        self.options = options
+        self.auto_connect = connect
+
+        if features is None:
+            features = () if options.legacy_firmware else SimulatedLogger.FEATURES
+
+        self.loggers = [SimulatedLogger(f'AA:00:00:00:00:{i + 1:02X}', f'BBQ{i + 1}', options.folders, options.files,
+                                        options.log_size, options.chunk_size, seed=i, features=features)
+                        for i in range(count)]
+        self.backend = SimulatedBackend(self.loggers, LinkProfile(options.mtu, options.latency, options.bandwidth,
+                                                                  write_without_response=not options.write_with_response,
+                                                                  drop_after=drop_after, ignore_every=ignore_every))
+        # Nothing is cached between sessions
+        self.directory = tempfile.mkdtemp()
+        self.scanner = Scanner(self.backend.scanner_class, self.backend.client_class,
+                               ListingCache(os.path.join(self.directory, 'listings.json')),
+                               KnownDevices(os.path.join(self.directory, 'devices.json')))
+        self.devices: List[Device] = []
+
+    async def connect(self, device: Device):
+        await device.acquire()
+
+    async def __aenter__(self):
+        for logger in self.loggers:
+            device = Device(self.scanner, BLEDevice(logger.address, logger.name))
+            self.scanner.devices[logger.address] = device
+            self.devices.append(device)
+
+        if self.auto_connect:
+            await asyncio.gather(*[self.connect(device) for device in self.devices])
+
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        for device in self.devices:
+            await device.release()
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+
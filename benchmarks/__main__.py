@@ -0,0 +1,50 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+
+from benchmarks import BENCHMARKS
+from benchmarks import parsing, protocol, startup  # registers the benchmarks
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmark the BLE protocol against simulated loggers.')
+    parser.add_argument('names', nargs='*', help=f'benchmarks to run (default: all of {", ".join(BENCHMARKS)})')
+    parser.add_argument('--mtu', type=int, default=23, help='ATT MTU of the simulated link')
+    parser.add_argument('--latency', type=float, default=0.015, help='one-way latency of the simulated link, in seconds')
+    parser.add_argument('--bandwidth', type=int, default=10 * 1024, help='throughput of the simulated link, in bytes per second')
+    parser.add_argument('--write-with-response', action='store_true', help='simulate a characteristic without write-without-response')
+    parser.add_argument('--legacy-firmware', action='store_true', help='simulate firmware without protocol extensions')
+    parser.add_argument('--window', type=int, help='log chunks in flight during downloads')
+    parser.add_argument('--devices', type=int, default=4, help='simulated loggers in fleet benchmarks')
+    parser.add_argument('--folders', type=int, default=4, help='folders on each simulated logger')
+    parser.add_argument('--files', type=int, default=3, help='files in each folder')
+    parser.add_argument('--log-size', type=int, default=16 * 1024, help='size of each log file, in bytes')
+    parser.add_argument('--chunk-size', type=int, default=128, help='log bytes sent by the firmware per getflog chunk')
+    parser.add_argument('--timeout', type=float, default=600.0, help='timeout of each benchmark, in seconds')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='do not silence the protocol output')
+    options = parser.parse_args()
+
+    names = options.names or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark {name}')
+
+    results = {}
+    for name in names:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if options.verbose else devnull):
+            results[name] = asyncio.run(BENCHMARKS[name](options))
+
+        for metric, value in results[name].items():
+            print(f'{name:<12} {metric:<32} {value:.3f}' if isinstance(value, float) else f'{name:<12} {metric:<32} {value}')
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({'options': vars(options), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+import io
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+import numpy
+from bleak.backends.device import BLEDevice
+
+from ble import Device, Scanner
+from ble.framing import LineFramer
+from ble.simulator import SimulatedLogger
+from benchmarks import benchmark
+from utils.export import export_columns, export_path, load_columns
+from utils.writer import FileWriter
+
+
+def notifications(options):
+    # The notification stream of a full log download, cut to the link MTU
+    logger = SimulatedLogger('AA:00:00:00:00:01', log_size=options.log_size, chunk_size=options.chunk_size)
+    folder = next(iter(logger.tree))
+    file = next(iter(logger.tree[folder]))
+    logger.handle_getslog(f'/{folder}/{file}')
+
+    stream = bytearray()
+    for offset in range(0, options.log_size, options.chunk_size):
+        stream += (logger.chunk(offset) + '\n').encode()
+
+    size = options.mtu - 3
+    return [bytearray(stream[i:i + size]) for i in range(0, len(stream), size)], len(stream)
+
+
+def legacy_frames(packets):
+    # handle_rx before the byte level framer
+    frames = 0
+    read_buffer = ''
+
+    for data in packets:
+        command = data.decode()
+        result = command.find('\n')
+
+        while result != -1:
+            read_buffer += command[0:result]
+            frames += 1
+            read_buffer = ''
+
+            command = command[result:-1]
+            result = command.find('\n')
+
+        read_buffer += command
+
+    return frames
+
+
+@benchmark('framing')
+async def framing(options):
+    packets, size = notifications(options)
+
+    start = time.perf_counter()
+    legacy_frames(packets)
+    legacy = time.perf_counter() - start
+
+    framer = LineFramer()
+    start = time.perf_counter()
+    for data in packets:
+        framer.feed(data)
+    current = time.perf_counter() - start
+
+    return {
+        'legacy framing (MiB/s)': size / 1024 / 1024 / legacy,
+        'framing (MiB/s)': size / 1024 / 1024 / current,
+        'framing (notifications/s)': len(packets) / current,
+    }
+
+
+def legacy_receive(device: Device, data: str):
+    # The hot branches of receive_cmd before the handler table
+    split = data.split(":")
+    command = split[0]
+    print(f"Received: {data} {command}")
+
+    if command == "imudata":
+        split2 = split[1].split(",")
+        device.imu_acceleration = (float(split2[0]), float(split2[1]), float(split2[2]))
+        device.imu_gyro = (float(split2[3]), float(split2[4]), float(split2[5]))
+    elif command == "info":
+        split2 = split[1].split(",")
+
+        device.battery = int(split2[0])
+        device.dtime = datetime.strptime(','.join(split2[1:7]), '%H,%M,%S,%d,%m,%y')
+        device.dtime_changed = True
+        device.imu_acceleration = (float(split2[7]), float(split2[8]), float(split2[9]))
+        device.imu_gyro = (float(split2[10]), float(split2[11]), float(split2[12]))
+    elif command == "getflog":
+        buf = split[1][0:-4]
+        device.download_written = device.download_written + device.download_file_stream.write(buf.replace('~', '\n'))
+        device.send_cmd(f"getflog:ok,*")
+
+        print(f"{device.download_written} / {device.download_size}")
+        device.folders_progress = device.download_written / device.download_size
+
+
+@benchmark('dispatch')
+async def dispatch(options):
+    logger = SimulatedLogger('AA:00:00:00:00:01', log_size=options.log_size, chunk_size=options.chunk_size)
+    folder = next(iter(logger.tree))
+    file = next(iter(logger.tree[folder]))
+    logger.handle_getslog(f'/{folder}/{file}')
+
+    messages = []
+    for offset in range(0, options.log_size, options.chunk_size):
+        messages.append(logger.chunk(offset))
+        messages.append(logger.handle_info('')[0])
+        messages.append(logger.imudata())
+
+    device = Device(Scanner(), BLEDevice(logger.address, logger.name))
+    device.download_size = options.log_size
+    directory = tempfile.mkdtemp()
+
+    device.download_file_stream = io.StringIO()
+    start = time.perf_counter()
+    for message in messages:
+        legacy_receive(device, message)
+    legacy = time.perf_counter() - start
+
+    device.download_file_stream = FileWriter(os.path.join(directory, 'dispatch.csv'))
+    start = time.perf_counter()
+    for message in messages:
+        await device.receive_cmd(message)
+    current = time.perf_counter() - start
+    await device.download_file_stream.close()
+    shutil.rmtree(directory)
+
+    return {
+        'legacy dispatch (messages/s)': len(messages) / legacy,
+        'dispatch (messages/s)': len(messages) / current,
+        'dispatch speed-up': legacy / current,
+    }
+
+
+@benchmark('writer')
+async def writer(options):
+    logger = SimulatedLogger('AA:00:00:00:00:01', log_size=options.log_size, chunk_size=options.chunk_size)
+    logger.handle_getslog(f'/{next(iter(logger.tree))}/{next(iter(next(iter(logger.tree.values()))))}')
+    payloads = [logger.chunk(offset)[8:-4] for offset in range(0, options.log_size, options.chunk_size)]
+    directory = tempfile.mkdtemp()
+
+    # Time the event loop spends per chunk, and until the file is synced to disk
+    start = time.perf_counter()
+    stream = open(os.path.join(directory, 'legacy.csv'), 'w', newline='')
+    for payload in payloads:
+        stream.write(payload.replace('~', '\n'))
+    stream.flush()
+    os.fsync(stream.fileno())
+    stream.close()
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    stream = FileWriter(os.path.join(directory, 'current.csv'))
+    stream.preallocate(options.log_size)
+    for payload in payloads:
+        stream.write(payload)
+    loop = time.perf_counter() - start
+    await stream.close()
+    current = time.perf_counter() - start
+
+    with open(os.path.join(directory, 'legacy.csv'), 'rb') as a, open(os.path.join(directory, 'current.csv'), 'rb') as b:
+        assert a.read() == b.read()
+
+    shutil.rmtree(directory)
+
+    return {
+        'legacy loop time per chunk (us)': legacy / len(payloads) * 1e6,
+        'loop time per chunk (us)': loop / len(payloads) * 1e6,
+        'time to synced file (s)': current,
+        'legacy time to synced file (s)': legacy,
+    }
+
+
+@benchmark('export')
+async def export(options):
+    logger = SimulatedLogger('AA:00:00:00:00:01', log_size=options.log_size, chunk_size=options.chunk_size)
+    folder = next(iter(logger.tree))
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'log.csv')
+
+    # Logs are cut at log_size, leave the partial last row out
+    content = logger.log_content(folder, next(iter(logger.tree[folder])))
+    with open(path, 'w', newline='') as f:
+        f.write(content[:content.rstrip('\n').rfind('\n') + 1])
+
+    start = time.perf_counter()
+    export_columns(path)
+    conversion = time.perf_counter() - start
+
+    # What the analysis pipeline pays on every read: parsing the CSV, or mapping the columns
+    start = time.perf_counter()
+    parsed = numpy.loadtxt(path, delimiter=',', skiprows=1)
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    columns = load_columns(export_path(path))
+    mapped = time.perf_counter() - start
+
+    assert all(numpy.array_equal(columns[name], parsed[:, i]) for i, name in enumerate(columns))
+    shutil.rmtree(directory)
+
+    return {
+        'export (MiB/s)': options.log_size / 1024 / 1024 / conversion,
+        'parse csv (ms)': legacy * 1000,
+        'map columns (ms)': mapped * 1000,
+        'read speed-up': legacy / mapped,
+    }
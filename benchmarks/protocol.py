@@ -0,0 +1,527 @@
+import asyncio
+import os
+import tempfile
+import time
+from typing import List
+
+from bleak.backends.device import BLEDevice
+
+from ble import SCAN_TIME, Device, UART_CHAR_UUID, UART_SAFE_SIZE, UART_SERVICE_UUID, Scanner
+from ble.fleet import FleetDownload
+from ble.listings import ListingCache
+from ble.pool import ConnectionPool
+from ble.registry import KnownDevices
+from ble.simulator import LinkProfile, SimulatedBackend, SimulatedLogger
+from ble.trace import TRACE_EXTENSION, replay
+from ble.transfers import TransferManager
+from benchmarks import Session, benchmark, wait_for
+
+# What MainWidget.update_alarms sends with every slot in use
+ALARM_SET = 'alarmSET:' + ','.join('1,12,30,90' for _ in range(12))
+
+
+async def legacy_send(client, command: str, response: bool = False):
+    # Transmit path before MTU negotiation: fixed 20 byte writes with 100 ms sleeps
+    command = command + "\n"
+
+    while len(command) > UART_SAFE_SIZE:
+        await client.write_gatt_char(UART_CHAR_UUID, bytearray((command[0:UART_SAFE_SIZE]).encode()), response)
+
+        command = command[UART_SAFE_SIZE:]
+        await asyncio.sleep(0.1)
+
+    if len(command) > 0:
+        await client.write_gatt_char(UART_CHAR_UUID, bytearray(command.encode()), response)
+
+
+def count_status(device) -> List[int]:
+    """ Counts the status updates the device receives, polled or pushed, in the returned list """
+    counter = [0]
+    receive_cmd = device.receive_cmd
+
+    async def counted(data: str):
+        counter[0] = counter[0] + data.startswith('info:')
+        await receive_cmd(data)
+
+    device.receive_cmd = counted
+    return counter
+
+
+@benchmark('connect')
+async def connect_to_ready(options):
+    results = {}
+
+    # Also with firmware that misses every 4th command, answered by retries
+    for ignore_every, name in [(0, 'connect to ready (s)'), (4, 'connect to ready, lossy (s)')]:
+        async with Session(options, connect=False, ignore_every=ignore_every) as session:
+            device = session.devices[0]
+
+            start = time.perf_counter()
+            await session.connect(device)
+            await asyncio.wait_for(device.ready.wait(), options.timeout)
+
+            results[name] = time.perf_counter() - start
+
+    return results
+
+
+@benchmark('send')
+async def send(options):
+    async with Session(options, connect=False) as session:
+        device = session.devices[0]
+        await device.connect_device()
+
+        start = time.perf_counter()
+        await legacy_send(device.client, ALARM_SET, device.write_response)
+        legacy = time.perf_counter() - start
+
+        start = time.perf_counter()
+        await device._send_cmd(ALARM_SET)
+        current = time.perf_counter() - start
+
+        return {
+            f'legacy send {len(ALARM_SET) + 1} bytes (s)': legacy,
+            f'send {len(ALARM_SET) + 1} bytes (s)': current,
+            'send speed-up': legacy / current,
+        }
+
+
+@benchmark('request')
+async def request(options):
+    async with Session(options) as session:
+        device = session.devices[0]
+        await wait_for(lambda: not device.folders_disabled, options.timeout)
+
+        count = 20
+        start = time.perf_counter()
+        for _ in range(count):
+            await device.request('getsettings')
+
+        return {'getsettings round trip (ms)': (time.perf_counter() - start) / count * 1000}
+
+
+async def list_device(options, features=None):
+    async with Session(options, features=features) as session:
+        device = session.devices[0]
+        logger = session.loggers[0]
+        await wait_for(lambda: not device.folders_disabled, options.timeout)
+
+        start = time.perf_counter()
+        await asyncio.wait_for(device.list_folders(), options.timeout)
+        cold = time.perf_counter() - start
+
+        listed = sum(len(folder.children) for folder in device.folders)
+
+        # A new log in the newest folder, only that folder should be listed again
+        newest = logger.tree[next(reversed(logger.tree))] if logger.tree else {}
+        newest[f'{len(newest):03d}'] = None
+
+        start = time.perf_counter()
+        await asyncio.wait_for(device.list_folders(), options.timeout)
+        warm = time.perf_counter() - start
+
+        return len(device.folders), listed, cold, warm
+
+
+@benchmark('list')
+async def list_folders(options):
+    folders, files, cold, warm = await list_device(options, features=('window', 'offset'))
+    results = {
+        f'list {folders} folders (s)': cold,
+        'names per second': (folders + files) / cold,
+        'incremental refresh (s)': warm,
+    }
+
+    if not options.legacy_firmware:
+        _, _, batched, _ = await list_device(options)
+        results['batched list (s)'] = batched
+        results['batched list speed-up'] = cold / batched
+
+    return results
+
+
+async def download_file(options, features=None):
+    async with Session(options, features=features) as session:
+        device = session.devices[0]
+        logger = session.loggers[0]
+        await wait_for(lambda: not device.folders_disabled, options.timeout)
+
+        if options.window is not None:
+            device.download_window = options.window
+
+        folder = next(iter(logger.tree))
+        file = next(iter(logger.tree[folder]))
+        expected = logger.log_content(folder, file)
+
+        with tempfile.TemporaryDirectory() as target:
+            path = os.path.join(target, f'{device.name}_{folder}_{file}.csv')
+
+            start = time.perf_counter()
+            await asyncio.wait_for(device.fetch_file(folder, file, path), options.timeout)
+            elapsed = time.perf_counter() - start
+
+            with open(path) as f:
+                intact = f.read() == expected
+
+        return len(expected) / 1024 / elapsed, elapsed, intact
+
+
+@benchmark('download')
+async def download(options):
+    speed, elapsed, intact = await download_file(options)
+    results = {
+        'download (KiB/s)': speed,
+        'download (s)': elapsed,
+        'download intact': intact,
+    }
+
+    if not options.legacy_firmware:
+        # The gain of the window alone, compression is measured by 'compression'
+        windowed, _, _ = await download_file(options, features=('window',))
+        legacy, _, _ = await download_file(options, features=())
+        results['windowed download (KiB/s)'] = windowed
+        results['stop-and-wait download (KiB/s)'] = legacy
+        results['download speed-up'] = windowed / legacy
+
+    return results
+
+
+@benchmark('compression')
+async def compression(options):
+    plain, _, _ = await download_file(options, features=('window', 'offset', 'batch'))
+    speed, elapsed, intact = await download_file(options)
+
+    return {
+        'plain download (KiB/s)': plain,
+        'compressed download (KiB/s)': speed,
+        'compressed download intact': intact,
+        'compression speed-up': speed / plain,
+    }
+
+
+async def download_fleet(options, max_connections):
+    async with Session(options, count=options.devices, connect=False) as session:
+        with tempfile.TemporaryDirectory() as target:
+            job = FleetDownload(session.devices, target, max_connections)
+
+            start = time.perf_counter()
+            await asyncio.wait_for(job.run(), options.timeout)
+            elapsed = time.perf_counter() - start
+
+            if len(job.errors) > 0:
+                raise next(iter(job.errors.values()))
+
+            return job.bytes_total / 1024 / elapsed, elapsed
+
+
+@benchmark('fleet')
+async def fleet(options):
+    speed, elapsed = await download_fleet(options, options.devices)
+    serial, _ = await download_fleet(options, 1)
+
+    return {
+        f'download all from {options.devices} devices (s)': elapsed,
+        'fleet download (KiB/s)': speed,
+        'serial fleet download (KiB/s)': serial,
+        'fleet speed-up': speed / serial if serial else 0.0,
+    }
+
+
+@benchmark('resume')
+async def resume(options):
+    # The link drops three times per file, every transfer must pick up where it stopped. Without
+    # compression, so the bytes on the link follow the size of the log.
+    async with Session(options, connect=False, features=('window', 'offset'),
+                       drop_after=options.log_size // 3 + 1) as session:
+        device = session.devices[0]
+        logger = session.loggers[0]
+
+        folder = next(iter(logger.tree))
+        file = next(iter(logger.tree[folder]))
+        expected = logger.log_content(folder, file)
+
+        with tempfile.TemporaryDirectory() as target:
+            transfers = TransferManager(os.path.join(target, 'transfers.json'))
+            transfers.backoff = 0.01
+
+            path = os.path.join(target, device.file_name(folder, file))
+            transfers.enqueue(device, folder, file, path)
+
+            start = time.perf_counter()
+            await asyncio.wait_for(transfers.start(device), options.timeout)
+            elapsed = time.perf_counter() - start
+
+            with open(path) as f:
+                intact = f.read() == expected
+
+        assert transfers.reconnects >= 3, f"The link dropped only {transfers.reconnects} times"
+
+        return {
+            'resumed download (s)': elapsed,
+            'resumed download (KiB/s)': len(expected) / 1024 / elapsed,
+            'reconnects': transfers.reconnects,
+            'resumed download intact': intact,
+        }
+
+
+@benchmark('telemetry')
+async def telemetry(options):
+    async with Session(options) as session:
+        device = session.devices[0]
+        await wait_for(lambda: not device.folders_disabled, options.timeout)
+
+        device.start_telemetry()
+        await wait_for(lambda: len(device.telemetry) > 0, options.timeout)
+
+        # Sustained rate, and what the samples cost on the event loop
+        duration = 3.0
+        received = len(device.telemetry)
+        spent = 0.0
+        receive_cmd = device.receive_cmd
+
+        async def timed(data: str):
+            nonlocal spent
+            start = time.perf_counter()
+            await receive_cmd(data)
+            spent = spent + time.perf_counter() - start
+
+        device.receive_cmd = timed
+        await asyncio.sleep(duration)
+        device.receive_cmd = receive_cmd
+        samples = len(device.telemetry) - received
+
+        device.stop_telemetry()
+
+        # A full buffer decimated for an 800 pixel wide plot
+        device.telemetry.extend(device.telemetry.ordered()[:1].repeat(device.telemetry.capacity, axis=0))
+        count = 30
+        start = time.perf_counter()
+        for _ in range(count):
+            device.telemetry.decimate(400)
+        decimate = (time.perf_counter() - start) / count
+
+        return {
+            'telemetry (samples/s)': samples / duration,
+            'loop time per sample (us)': spent / max(samples, 1) * 1e6,
+            'decimate full buffer (ms)': decimate * 1000,
+            'buffer size (KiB)': device.telemetry.data.nbytes / 1024,
+        }
+
+
+async def legacy_scan(scanner, duration: float):
+    # Scan before streaming discovery: everything is reported once the fixed window closes
+    devices = {}
+
+    def on_detect(ble, adv):
+        if ble.address not in devices and UART_SERVICE_UUID.lower() in adv.service_uuids:
+            devices[ble.address] = ble
+
+    async with scanner.scanner_class(detection_callback=on_detect):
+        await asyncio.sleep(duration)
+
+    return devices
+
+
+@benchmark('scan')
+async def scan(options):
+    loggers = [SimulatedLogger(f'AA:00:00:{i // 256:02X}:{i % 256:02X}:01', f'BBQ{i + 1}', seed=i)
+               for i in range(options.devices)]
+    backend = SimulatedBackend(loggers, LinkProfile(options.mtu, options.latency, options.bandwidth))
+
+    with tempfile.TemporaryDirectory() as directory:
+        def create_scanner():
+            return Scanner(backend.scanner_class, backend.client_class,
+                           ListingCache(os.path.join(directory, 'listings.json')),
+                           KnownDevices(os.path.join(directory, 'devices.json')))
+
+        start = time.perf_counter()
+        await legacy_scan(create_scanner(), SCAN_TIME)
+        legacy = time.perf_counter() - start
+
+        # Streaming, stopping once the loggers asked for are all found
+        scanner = create_scanner()
+        found = []
+        scanner.device_found.connect(lambda device: found.append(time.perf_counter() - start))
+
+        start = time.perf_counter()
+        await scanner.scan_ble_devices(SCAN_TIME, {logger.address for logger in loggers})
+        elapsed = time.perf_counter() - start
+
+    return {
+        'legacy discovery (s)': legacy,
+        'first logger found (ms)': found[0] * 1000,
+        'mean discovery per logger (ms)': sum(found) / len(found) * 1000,
+        'all found, scan stopped (s)': elapsed,
+        'discovery speed-up': legacy / elapsed,
+    }
+
+
+@benchmark('reconnect')
+async def reconnect(options):
+    logger = SimulatedLogger('AA:00:00:00:00:01', 'BBQ1', seed=0)
+    backend = SimulatedBackend([logger], LinkProfile(options.mtu, options.latency, options.bandwidth))
+
+    with tempfile.TemporaryDirectory() as directory:
+        def create_scanner():
+            return Scanner(backend.scanner_class, backend.client_class,
+                           ListingCache(os.path.join(directory, 'listings.json')),
+                           KnownDevices(os.path.join(directory, 'devices.json')))
+
+        async def connect(device):
+            await device.acquire()
+            await wait_for(lambda: not device.folders_disabled, options.timeout)
+            await device.release()
+
+        # Without the registry every session started with a full scan, nothing tells it when to stop
+        scanner = create_scanner()
+        start = time.perf_counter()
+        await scanner.scan_ble_devices(SCAN_TIME)
+        await connect(scanner.devices[logger.address])
+        scanned = time.perf_counter() - start
+
+        # Next run, connected to by address from the known devices
+        scanner = create_scanner()
+        start = time.perf_counter()
+        device, = scanner.add_known_devices()
+        listed = time.perf_counter() - start
+        await connect(device)
+        known = time.perf_counter() - start
+
+    return {
+        'full scan and connect (s)': scanned,
+        'known logger listed (ms)': listed * 1000,
+        'known logger connected (s)': known,
+        'speed-up': scanned / known,
+    }
+
+
+@benchmark('switch')
+async def switch(options):
+    switches = 4
+    # Long enough for a few background polls
+    duration = 30.0
+
+    async with Session(options, count=2, connect=False) as session:
+        async def ready(device):
+            await asyncio.wait_for(device.ready.wait(), options.timeout)
+
+        # Disconnecting from the previous device on every selection
+        start = time.perf_counter()
+        previous = None
+        for i in range(switches):
+            device = session.devices[i % 2]
+            if previous is not None:
+                await previous.release()
+
+            await device.acquire()
+            await ready(device)
+            previous = device
+
+        reconnecting = (time.perf_counter() - start) / switches
+        await previous.release()
+
+        # Both kept in the pool once each was selected
+        pool = ConnectionPool(2)
+        for device in session.devices:
+            await pool.activate(device)
+            await ready(device)
+
+        start = time.perf_counter()
+        for i in range(switches):
+            await pool.activate(session.devices[i % 2])
+            await ready(session.devices[i % 2])
+
+        pooled = (time.perf_counter() - start) / switches
+
+        pool.deactivate()
+        await pool.activate(session.devices[0])
+
+        updates = [count_status(device) for device in session.devices]
+        await asyncio.sleep(duration)
+        polls = [counter[0] / duration for counter in updates]
+        await pool.close()
+
+    return {
+        'switch, reconnecting (s)': reconnecting,
+        'switch, pooled (ms)': pooled * 1000,
+        'speed-up': reconnecting / pooled,
+        'foreground status updates (1/s)': polls[0],
+        'background status updates (1/s)': polls[1],
+    }
+
+
+@benchmark('polling')
+async def polling(options):
+    duration = 6.0
+    results = {}
+
+    for name, features in [('polled', tuple(f for f in SimulatedLogger.FEATURES if f != 'status')),
+                           ('pushed', SimulatedLogger.FEATURES)]:
+        async with Session(options, features=features) as session:
+            device = session.devices[0]
+            logger = session.loggers[0]
+            await asyncio.wait_for(device.ready.wait(), options.timeout)
+
+            updates = count_status(device)
+
+            for visible in [True, False]:
+                device.status_visible = visible
+                await asyncio.sleep(1.0)
+
+                updates[0] = 0
+                await asyncio.sleep(duration)
+                results[f'{name}, {"status on screen" if visible else "status hidden"} (1/s)'] = updates[0] / duration
+
+            # A change shows up on the next poll, or as soon as it is pushed
+            seen = []
+            for _ in range(4):
+                await asyncio.sleep(0.7)
+
+                start = time.perf_counter()
+                logger.battery = logger.battery - 10
+                await wait_for(lambda: device.battery == logger.battery, options.timeout)
+                seen.append(time.perf_counter() - start)
+
+            results[f'{name}, battery change seen after (s)'] = sum(seen) / len(seen)
+
+            folder = next(iter(logger.tree))
+            with tempfile.TemporaryDirectory() as target:
+                updates[0] = 0
+                await asyncio.wait_for(device.fetch_file(folder, next(iter(logger.tree[folder])),
+                                                         os.path.join(target, 'log.csv')), options.timeout)
+                results[f'{name}, updates during download'] = updates[0]
+
+    return results
+
+
+@benchmark('replay')
+async def replay_trace(options):
+    with tempfile.TemporaryDirectory() as directory:
+        # Recorded from a simulated session: connect, list and download a folder
+        async with Session(options, connect=False) as session:
+            session.scanner.trace_directory = directory
+            device = session.devices[0]
+            await session.connect(device)
+            await asyncio.wait_for(device.ready.wait(), options.timeout)
+
+            folders = await asyncio.wait_for(device.list_folders(), options.timeout)
+            device.download_folder(folders[0].name, directory)
+            await asyncio.wait_for(asyncio.shield(device.download_done), options.timeout)
+            await device.release()
+
+        path, = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(TRACE_EXTENSION)]
+        expected = {name: open(os.path.join(directory, name)).read() for name in os.listdir(directory)
+                    if name.endswith('.csv')}
+
+        replayed = os.path.join(directory, 'replayed')
+        os.makedirs(replayed)
+
+        device = Device(session.scanner, BLEDevice(device.ble.address, device.name))
+        results = await replay(path, device, replayed)
+
+        results['trace size (KiB)'] = os.path.getsize(path) / 1024
+        results['replayed downloads intact'] = all(open(os.path.join(replayed, name)).read() == content
+                                                   for name, content in expected.items())
+        results['replay speed-up'] = results['trace duration (s)'] / results['replay (s)']
+
+    return results
@@ -0,0 +1,50 @@
+import asyncio
+import os
+import sys
+import time
+
+from benchmarks import benchmark
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def run(*args, env=None, timeout: float = 60.0):
+    # Cold start of a new interpreter, as the user gets it
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(sys.executable, *args, cwd=ROOT, env=env,
+                                                   stdout=asyncio.subprocess.DEVNULL,
+                                                   stderr=asyncio.subprocess.PIPE)
+    _, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    return time.perf_counter() - start, process.returncode, stderr.decode()
+
+
+@benchmark('startup')
+async def startup(options):
+    interpreter, _, _ = await run('-c', 'pass')
+    cli, _, _ = await run('main.py', 'harvest', '--help')
+    core, _, _ = await run('-c', 'import ble, ble.fleet, ble.transfers')
+    # Loaded after the first paint, once the scan starts
+    bleak, _, _ = await run('-c', 'import ble; ble.load_bleak()')
+
+    results = {
+        'interpreter (ms)': interpreter * 1000,
+        'cli ready (ms)': cli * 1000,
+        'import protocol core (ms)': (core - interpreter) * 1000,
+        'import bleak (ms)': (bleak - core) * 1000,
+    }
+
+    # Time to first paint of the GUI, reported by main.py itself
+    env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get('QT_QPA_PLATFORM', 'offscreen'))
+    elapsed, code, stderr = await run('main.py', '--startup-profile', '--exit-after-startup', env=env,
+                                      timeout=options.timeout)
+    if code != 0:
+        results['gui startup'] = 'unavailable: ' + (stderr.strip().splitlines() or ['failed'])[-1]
+        return results
+
+    for line in stderr.splitlines():
+        if line.endswith(' ms'):
+            phase, value, _ = line.rsplit(None, 2)
+            results[f'{phase.strip()} (ms)'] = float(value)
+
+    results['process exit (ms)'] = elapsed * 1000
+    return results
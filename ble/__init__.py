@@ -2,44 +2,144 @@ import asyncio
 import json
 import os
 import sys
-from asyncio import Task
+import time
+from asyncio import Task, Future
+from collections import deque
 from datetime import datetime
-
-from PySide2.QtCore import QObject, Signal
-from PySide2.QtWidgets import QLabel, QListWidgetItem, QMessageBox
-from bleak import BleakScanner, BleakClient, BleakError
-from bleak.backends.device import BLEDevice
-from bleak.backends.scanner import AdvertisementData
-
+from typing import Callable, Deque, Dict, List, Set
+
+from ble.framing import LineFramer, ZlibDecoder
+from ble.listings import ListingCache
+from ble.metrics import DeviceMetrics
+from ble.registry import KnownDevices
+from ble.signals import Signal
+from ble.trace import RX, TX, TraceRecorder, trace_path
 from utils import Alarm, LogFolder, LogFile, human_readable_size
-from utils.dialogs import QAsyncMessageBox
+from utils.writer import FileWriter, written_size
 
 UART_SERVICE_UUID = "0000ffe0-0000-1000-8000-00805f9b34fb"
 UART_CHAR_UUID = "0000ffe1-0000-1000-8000-00805f9b34fb"
 # All BLE devices have MTU of at least 23. Subtracting 3 bytes overhead, we can
 # safely send 20 bytes at a time to any device supporting this service.
 UART_SAFE_SIZE = 20
+# Writes without response that the stack refuses are retried, backing off
+# between WRITE_GAP_MIN and WRITE_GAP_MAX seconds.
+WRITE_RETRIES = 5
+WRITE_GAP_MIN = 0.005
+WRITE_GAP_MAX = 0.1
+# Log chunks the firmware may send ahead of our acks, on firmware with the
+# 'window' feature. Acks are cumulative and sent every half window. Chunk
+# sequence numbers wrap at 256, so the window must stay below 128.
+DOWNLOAD_WINDOW = 8
+# Transfer encoding requested from firmware with the 'zlib' feature: logs are
+# sent as a base64 encoded deflate stream instead of plain CSV text.
+DOWNLOAD_ENCODING = "zlib"
+# Seconds a download may go without receiving data before it is given up on,
+# large files take long so there is no limit on the whole transfer.
+DOWNLOAD_STALL_TIMEOUT = 30.0
+# IMU samples per second requested from firmware with the 'stream' feature.
+# Firmware without it is polled with 'info' every tick instead.
+TELEMETRY_RATE = 200
+# Seconds spent looking for loggers on each scan
+SCAN_TIME = 5.0
+# Devices connected at once, by fleet jobs
+MAX_CONNECTIONS = 4
+# Devices the GUI keeps connected after switching away from them, and the
+# seconds one may stay unused in the background before it is disconnected
+POOL_SIZE = 4
+POOL_IDLE_TIMEOUT = 300.0
+# Seconds between status updates of a connected device, of the one whose
+# status is on screen, and of those in the background. Polled with 'info',
+# or pushed by firmware with the 'status' feature. Neither while a transfer
+# has the link busy.
+POLL_INTERVAL = 2.0
+STATUS_POLL_INTERVAL = 1.0
+BACKGROUND_POLL_INTERVAL = 10.0
+# Seconds to wait for the reply of a request
+REQUEST_TIMEOUT = 5.0
+# Queries sent on connect, all at once. The panels are enabled once every
+# one was answered, or given up on after its retries ran out.
+HANDSHAKE = ["info", "getsettings", "alarmGET", "firmware", "alarmGET"]
+HANDSHAKE_TIMEOUT = 1.0
+HANDSHAKE_RETRIES = 3
+# Commands whose reply comes back under a different name
+REPLIES = {
+    'alarmGET': 'alarm',
+    'synctime': 'time',
+    'getnamefolders': 'namefolder',
+    'getnamefiles': 'namefiles',
+    'startlog': 'getflog',
+}
+
+
+# bleak is imported by load_bleak() once a scan or a connection needs it. Importing
+# it probes the platform for a backend, on Linux by running bluetoothctl, which
+# would hold up the first paint of the window.
+BleakScanner = None
+BleakClient = None
+BLEDevice = None
+AdvertisementData = None
+
+
+class BleakError(Exception):
+    """ Stands in for bleak's until it is loaded, so `except BleakError` works before """
+
+
+def load_bleak():
+    global BleakScanner, BleakClient, BleakError, BLEDevice, AdvertisementData
+
+    if BleakScanner is None:
+        from bleak import BleakScanner, BleakClient, BleakError
+        from bleak.backends.device import BLEDevice
+        from bleak.backends.scanner import AdvertisementData
+
+
+class Device:
+    pass
 
 
-class Device(QObject):
+class Scanner:
     pass
 
 
-class Scanner(QObject):
-    pass
+# Handlers of the commands received from the device, by command name. Each one
+# is called with the device and the command arguments, and returns the parsed
+# reply handed to pending requests.
+HANDLERS: Dict[str, Callable[[Device, str], object]] = {}
+
+
+def handler(command: str):
+    def decorator(func):
+        HANDLERS[command] = func
+        return func
+
+    return decorator
+
+
+def reply_to(command: str) -> str:
+    name = command.split(":")[0]
+    return REPLIES.get(name, name)
+
+
+def parse_time(fields: List[str]) -> datetime:
+    # '%H,%M,%S,%d,%m,%y' without going through strptime
+    hour, minute, second, day, month, year = fields
+    return datetime(2000 + int(year), int(month), int(day), int(hour), int(minute), int(second))
 
 
-class Device(QObject):
+class Device:
     name: str
-    client: BleakClient
+    client: 'BleakClient' = None
 
     runtask: Task = None
+    writer_task: Task = None
+    users = 0
 
     updated = Signal(Device)
-    queued_commands = []
 
-    list_widget: QListWidgetItem = None
-    list_widget_label: QLabel = None
+    # QListWidgetItem and QLabel of the device, when shown in the GUI
+    list_widget = None
+    list_widget_label = None
 
     dtime: datetime = datetime.min
     dtime_changed: bool = True
@@ -47,13 +147,17 @@ class Device(QObject):
     alarm_time: datetime = datetime.min
 
     battery: int = 0
+    battery_changed: bool = True
+
     firmware: str = 'unknown'
+    firmware_changed: bool = True
 
     settings = (0, 0)
     settings_changed: bool = True
 
     imu_acceleration = (0, 0, 0)
     imu_gyro = (0, 0, 0)
+    imu_changed: bool = True
 
     alarms = [Alarm()] * 12
     alarms_changed: bool = True
@@ -67,309 +171,935 @@ class Device(QObject):
     folders_error = False
     folders_progress = 0
     folders_message = ""
+    # folders_disabled, folders_progress or folders_message changed
+    folders_status_changed = True
+
+    folders_listed: Future = None
 
     folder_pending_delete = ""
 
     download_size = 0
     download_written = 0
+    download_offset = 0
     download_file_stream = None
-    download_folder = None
+    download_folder_name = None
     download_folder_path = None
-    download_folder_files = []
-
-    def __init__(self, scanner: Scanner, ble: BLEDevice):
-        QObject.__init__(self)
-
+    download_done: Future = None
+    download_window = DOWNLOAD_WINDOW
+    download_windowed = False
+    download_chunks = 0
+    download_encoding = DOWNLOAD_ENCODING
+    download_decoder: ZlibDecoder = None
+
+    # RingBuffer of the latest IMU samples, once telemetry was started
+    telemetry = None
+    telemetry_rate = 0
+    telemetry_changed: bool = False
+
+    write_size = UART_SAFE_SIZE
+    write_response = False
+    write_gap = 0.0
+
+    # Recording the connection, when the scanner has a trace directory
+    trace: TraceRecorder = None
+
+    # Kept connected but not on screen, polled less often
+    background = False
+    # Status shown in the GUI, polled more often
+    status_visible = False
+    # Milliseconds between pushes asked of firmware with the 'status' feature, None before asking
+    status_push = None
+
+    def __init__(self, scanner: Scanner, ble: 'BLEDevice'):
         self.scanner = scanner
         self.ble = ble
         self.name = ble.name if len(ble.name) > 0 else ble.address
-        self.read_buffer = ''
+        self.rssi = ble.rssi
+        self.framer = LineFramer()
         self.running = False
 
+        self.features = set()
+        self.download_folder_files = []
+
+        self.folders = scanner.listings.get(ble.address)
+        self.folders_listing = []
+
+        self.ready: asyncio.Event = None
+        self.download_lock = asyncio.Lock()
+        self.command_queue: asyncio.Queue = None
+        self.pending_requests: Dict[str, Deque[Future]] = {}
+        self.metrics = DeviceMetrics()
+
     #
     #
     #
 
+    def metric_labels(self) -> Dict[str, str]:
+        return {'address': self.ble.address, 'name': self.name, 'firmware': self.firmware}
+
+    def update_advertisement(self, ble: 'BLEDevice') -> bool:
+        """ Take the RSSI and name of a new advertisement, returning whether they changed """
+        changed = ble.rssi != self.rssi
+        self.rssi = ble.rssi
+
+        # The name may only come with a later scan response
+        if self.name == self.ble.address and len(ble.name) > 0:
+            self.name = ble.name
+            changed = True
+
+        # A known device added without scanning, the backend connects faster with what discovery found
+        if self.ble.details is None and not self.running:
+            self.ble = ble
+
+        return changed
+
+    def mark_changed(self):
+        self.dtime_changed = True
+        self.battery_changed = True
+        self.firmware_changed = True
+        self.settings_changed = True
+        self.imu_changed = True
+        self.telemetry_changed = True
+        self.alarms_changed = True
+        self.folders_changed = True
+        self.folders_status_changed = True
+
+    def set_battery(self, battery: int):
+        if battery != self.battery:
+            self.battery = battery
+            self.battery_changed = True
+
+    def set_imu(self, acceleration, gyro):
+        if acceleration != self.imu_acceleration or gyro != self.imu_gyro:
+            self.imu_acceleration = acceleration
+            self.imu_gyro = gyro
+            self.imu_changed = True
+
+    def set_folders_status(self, progress: float, message: str):
+        self.folders_progress = progress
+        self.folders_message = message
+        self.folders_status_changed = True
+
+    def start_telemetry(self, rate: int = TELEMETRY_RATE):
+        """ Feed IMU samples into `telemetry`, streamed by the firmware when it can """
+        if self.telemetry is None:
+            # Loads numpy, only worth it once telemetry is used
+            from ble.telemetry import RingBuffer
+            self.telemetry = RingBuffer()
+
+        self.telemetry_rate = rate
+        if "stream" in self.features:
+            self.send_cmd(f"imustream:{rate},*")
+
+    def set_background(self, background: bool):
+        if background == self.background:
+            return
+
+        self.background = background
+
+        if not background and self.running and not self.folders_disabled:
+            # Refresh what was polled slowly while in the background
+            self.send_cmd("info")
+
+    def poll_interval(self):
+        """ Seconds between status updates, None while a transfer has the link busy """
+        if self.folders_pending or (self.download_done is not None and not self.download_done.done()):
+            return None
+
+        if self.background:
+            return BACKGROUND_POLL_INTERVAL
+
+        if self.status_visible:
+            return STATUS_POLL_INTERVAL
+
+        return POLL_INTERVAL
+
+    def stop_telemetry(self):
+        if self.telemetry_rate > 0 and "stream" in self.features and self.running:
+            self.send_cmd("imustream:0,*")
+
+        self.telemetry_rate = 0
+
     def delete_folder(self, folder):
         self.folder_pending_delete = folder
         self.send_cmd(f"delfolder:{folder},*")
 
+    def file_name(self, folder, file):
+        return f'{self.name}_{folder}_{file}.csv'
+
+    async def list_folders(self) -> List[LogFolder]:
+        """ List the folders and files on the device, or wait for the listing in progress """
+        if self.folders_listed is None or self.folders_listed.done():
+            self.folders_listed = asyncio.get_event_loop().create_future()
+            self.folders_pending = True
+
+            if "batch" in self.features:
+                # The whole tree in one transfer, instead of a round trip per name
+                self.folders_listing = []
+                self.send_cmd("lstree:*")
+            else:
+                self.send_cmd("gnfolders:*")
+
+        return await asyncio.shield(self.folders_listed)
+
     def download_folder(self, folderId, target_path):
         folder = next(i for i in self.folders if i.name == folderId)
-        self.download_folder = folderId
+        self.download_folder_name = folderId
         self.download_folder_path = target_path
         self.download_folder_files = [i.name for i in folder.children]
         self.download_file(folderId, self.download_folder_files[0],
-                           os.path.join(target_path, f'{self.name}_{folderId}_{self.download_folder_files[0]}.csv'))
+                           os.path.join(target_path, self.file_name(folderId, self.download_folder_files[0])))
 
-    def download_file(self, folder, file, target_path):
+    def download_file(self, folder, file, target_path, offset: int = 0):
         if file in self.download_folder_files:
             self.download_folder_files.remove(file)
 
-        print(f'getslog:/{folder}/{file}')
+        if self.download_done is None or self.download_done.done():
+            self.download_done = asyncio.get_event_loop().create_future()
+
+        # Resume after the first `offset` bytes already on disk, when the firmware can
+        self.download_offset = offset if "offset" in self.features else 0
+        self.download_file_stream = FileWriter(target_path, self.download_offset)
+
+        print(f'getslog:/{folder}/{file} to {target_path} from {self.download_offset}')
 
-        self.download_file_stream = open(target_path, 'w')
-        print(target_path)
         self.send_cmd(f'getslog:/{folder}/{file}')
 
+    async def fetch_file(self, folder, file, target_path, resume: bool = False):
+        """
+        Download a single file, returning once it is written. There is a
+        single download on the link at a time, other callers wait their turn.
+        With `resume`, the download continues after what is already on disk.
+        Raises asyncio.TimeoutError once no data arrived for
+        DOWNLOAD_STALL_TIMEOUT seconds, the link may be up but stuck.
+        """
+        async with self.download_lock:
+            # What an interrupted download left on disk is only complete once its writer is done
+            if self.download_file_stream is not None:
+                await asyncio.wait([self.download_file_stream.close()])
+
+            offset = 0
+            if resume and os.path.exists(target_path):
+                offset = written_size(target_path)
+
+            self.download_folder_files = []
+            self.download_file(folder, file, target_path, offset)
+            done = self.download_done
+
+            written = None
+            while True:
+                await asyncio.wait([done], timeout=DOWNLOAD_STALL_TIMEOUT)
+                if done.done():
+                    return done.result()
+
+                if self.download_written == written:
+                    error = asyncio.TimeoutError(f"No data received for {file} in {DOWNLOAD_STALL_TIMEOUT:g} s")
+                    self._abort_download(error)
+                    raise error
+
+                written = self.download_written
+
     async def _send_cmd(self, command: str):
         if not self.running:
             return
 
-        command = command + "\n"
+        data = memoryview((command + "\n").encode())
+
+        if self.trace is not None:
+            self.trace.record(TX, data)
+
+        # Acks of log chunks are not answered one for one
+        self.metrics.command_sent(command.split(":")[0], None if command.startswith("getflog") else reply_to(command))
+
+        for i in range(0, len(data), self.write_size):
+            await self._write(data[i:i + self.write_size])
+
+        self.metrics.queued(self.command_queue.qsize())
+
+    async def _write(self, data: memoryview):
+        for attempt in range(WRITE_RETRIES):
+            if self.write_gap > 0:
+                await asyncio.sleep(self.write_gap)
+
+            try:
+                await self.client.write_gatt_char(UART_CHAR_UUID, data, self.write_response)
+            except BleakError:
+                if attempt + 1 == WRITE_RETRIES:
+                    raise
+
+                self.metrics.count('write_retries')
+
+                if not self.write_response and attempt + 2 == WRITE_RETRIES:
+                    # Last attempt, fall back to writes with response
+                    self.write_response = True
+
+                self.write_gap = min(max(self.write_gap * 2, WRITE_GAP_MIN), WRITE_GAP_MAX)
+                continue
+
+            self.write_gap = self.write_gap / 2 if self.write_gap > WRITE_GAP_MIN else 0
+            self.metrics.count('frames_sent')
+            self.metrics.count('bytes_sent', len(data))
+            return
+
+    async def _negotiate_write(self):
+        mtu = None
+        try:
+            if hasattr(self.client, '_acquire_mtu'):
+                # BlueZ only reports the real MTU once it has been acquired
+                await self.client._acquire_mtu()
 
-        while len(command) > UART_SAFE_SIZE:
-            await self.client.write_gatt_char(UART_CHAR_UUID, bytearray((command[0:UART_SAFE_SIZE]).encode()))
+            mtu = getattr(self.client, 'mtu_size', None)
+        except Exception as ex:
+            print(ex)
 
-            command = command[UART_SAFE_SIZE:]
-            await asyncio.sleep(0.1)
+        self.write_size = max(mtu - 3, UART_SAFE_SIZE) if mtu else UART_SAFE_SIZE
 
-        if len(command) > 0:
-            await self.client.write_gatt_char(UART_CHAR_UUID, bytearray(command.encode()))
+        try:
+            services = await self.client.get_services()
+            char = services.get_characteristic(UART_CHAR_UUID)
+            self.write_response = 'write-without-response' not in char.properties
+        except Exception as ex:
+            print(ex)
+            self.write_response = False
+
+        self.write_gap = 0.0
+        print(f"Writing {self.write_size} bytes per packet, {'with' if self.write_response else 'without'} response")
 
     def send_cmd(self, command: str):
         if not self.running:
             return
 
-        self.queued_commands.append(command)
+        self.command_queue.put_nowait(command)
+        self.metrics.queued(self.command_queue.qsize())
+
+    async def request(self, command: str, reply: str = None, timeout: float = REQUEST_TIMEOUT):
+        """ Send a command and wait for its reply, as parsed by receive_cmd """
+        if not self.running:
+            load_bleak()
+            raise BleakError(f"Device {self.name} is not connected")
+
+        if reply is None:
+            reply = reply_to(command)
+
+        future = asyncio.get_event_loop().create_future()
+        pending = self.pending_requests.setdefault(reply, deque())
+        pending.append(future)
+
+        self.send_cmd(command)
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.metrics.count('request_timeouts')
+            raise
+        finally:
+            if future in pending:
+                pending.remove(future)
+
+    def _resolve(self, command: str, result=None, error: Exception = None):
+        pending = self.pending_requests.get(command)
+        while pending:
+            future = pending.popleft()
+            if future.done():
+                continue
+
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+            return
+
+    def _fail_requests(self, error: Exception):
+        for pending in self.pending_requests.values():
+            for future in pending:
+                if not future.done():
+                    future.set_exception(error)
+
+        self.pending_requests.clear()
+
+        for future in [self.folders_listed, self.download_done]:
+            if future is not None and not future.done():
+                future.set_exception(error)
+                # Nobody may be waiting on it, avoid the 'exception never retrieved' warning
+                future.exception()
+
+        self.folders_pending = False
+
+    async def _writer(self):
+        while True:
+            command = await self.command_queue.get()
+
+            try:
+                await self._send_cmd(command)
+            except Exception as ex:
+                print(ex)
 
     #
     #
     #
 
     async def receive_cmd(self, data: str):
-        split = data.split(":")
-        command = split[0]
-        print(f"Received: {data} {command}")
+        command, _, args = data.partition(":")
+        self.metrics.line_received(command)
 
-        try:
-            if command == "ping":
-                self.send_cmd("pong")
-            elif command == "time":
-                self.dtime = datetime.strptime(split[1], '%H,%M,%S,%d,%m,%y')
-                self.dtime_changed = True
-            elif command == "battery":
-                self.battery = int(split[1])
-            elif command == "firmware":
-                self.firmware = split[1]
-            elif command == "getsettings":
-                split2 = split[1].split(",")
-                self.settings = (int(split2[0]), int(split2[1]))
-                self.settings_changed = True
-            elif command == "setsettings":
-                if split[1] == "ok":
-                    self.send_cmd("getsettings")
-            elif command == "imudata":
-                split2 = split[1].split(",")
-                self.imu_acceleration = (float(split2[0]), float(split2[1]), float(split2[2]))
-                self.imu_gyro = (float(split2[3]), float(split2[4]), float(split2[5]))
-            elif command == "info":
-                split2 = split[1].split(",")
-
-                self.battery = int(split2[0])
-                self.dtime = datetime.strptime(','.join(split2[1:7]), '%H,%M,%S,%d,%m,%y')
-                self.dtime_changed = True
-                self.imu_acceleration = (float(split2[7]), float(split2[8]), float(split2[9]))
-                self.imu_gyro = (float(split2[10]), float(split2[11]), float(split2[12]))
-            elif command == "alarm":
-                split2 = split[1].split(",")
-                args = split2[1:]  # ignore 'all'
-                for i in range(12):
-                    self.alarms[i] = Alarm(int(args[i * 4 + 1]), int(args[i * 4 + 2]), int(args[i * 4 + 3]),
-                                           args[i * 4 + 0] == '1')
-
-                print(self.alarms)
-
-                self.alarms_changed = True
-            elif command == "alarmSET":
-                if split[1] == "OK":
-                    self.send_cmd("alarmGET")
-            elif command == "delfolder":
-                split2 = split[1].split(",")
-
-                if split2[0] == "ok":
-                    self.folders = [i for i in self.folders if i.name != self.folder_pending_delete]
-                    self.folders_changed = True
-                else:
-                    print('Fail')
-
-                self.folder_pending_delete = ""
-            elif command == "gnfolders":
-                split2 = split[1].split(",")
-
-                self.folders = [0] * int(split2[1])
-                self.send_cmd("getnamefolders:*")
-            elif command == "namefolder":
-                split2 = split[1].split(",")
-                folderId = int(split2[1])
-
-                self.folders_progress = (folderId + 1) / len(self.folders) * 0.5
-                self.folders_message = f"Received folder {split2[2]} {folderId + 1}/{len(self.folders)}"
-
-                self.folders[folderId] = LogFolder(split2[2], [])
-
-                if folderId + 1 < len(self.folders):
-                    self.send_cmd("getnamefolders:*")
-                else:
-                    self.folders_index = 0
-                    folder = self.folders[self.folders_index]
-                    self.send_cmd(f"gnfiles:{folder.name},*")
-
-            elif command == "gnfiles":
-                split2 = split[1].split(",")
-                folder = self.folders[self.folders_index]
-
-                folder.children = [0] * int(split2[1])
-                self.send_cmd(f"getnamefiles:*")
-
-            elif command == "namefiles":
-                split2 = split[1].split(",")
-                fileId = int(split2[1])
-                folder = self.folders[self.folders_index]
-
-                self.folders_progress = 0.5 + (fileId + 1) / len(folder.children) * 0.5
-                self.folders_message = f"Received file {fileId + 1}/{len(folder.children)}"
-
-                folder.children[fileId] = LogFile(split2[2])
-
-                if fileId + 1 < len(folder.children):
-                    self.send_cmd(f"getnamefiles:*")
-                elif self.folders_index + 1 < len(self.folders):
-                    self.folders_index = self.folders_index + 1
-                    folder = self.folders[self.folders_index]
-                    self.send_cmd(f"gnfiles:{folder.name},*")
-                else:
-                    self.folders_pending = False
-                    self.folders_changed = True
-
-            elif command == "getslog":
-                split2 = split[1].split(",")
-                self.download_size = int(split2[0])
-                self.download_written = 0
-                self.folders_progress = 0
-
-                self.send_cmd(f"startlog:*")
-
-            elif command == "getflog":
-                buf = split[1][0:-4]
-                self.download_written = self.download_written + self.download_file_stream.write(buf.replace('~', '\n'))
-                self.send_cmd(f"getflog:ok,*")
-
-                print(f"{self.download_written} / {self.download_size}")
-                self.folders_progress = self.download_written / self.download_size
-                self.folders_message = f"{human_readable_size(self.download_written)}/{human_readable_size(self.download_size)}"
-
-            elif command.startswith("endlog"):
-                self.folders_message = 'Finished!'
-
-                self.download_file_stream.flush()
-                self.download_file_stream.close()
-
-                if len(self.download_folder_files) > 0:
-                    self.download_file(self.download_folder, self.download_folder_files[0],
-                                       os.path.join(self.download_folder_path,
-                                                    f'{self.download_folder}_{self.download_folder_files[0]}.csv'))
+        handler = HANDLERS.get(command)
+        if handler is None and command.startswith("endlog"):
+            handler = HANDLERS["endlog"]
 
+        if handler is None:
+            print(f"Unknown command: {data}")
+            self.updated.emit(self)
+            return
 
+        try:
+            result = handler(self, args)
         except Exception as e:
-            print(e)
+            print(f"{command}: {e}")
+            self._resolve(command, error=e)
+        else:
+            self._resolve(command, result)
 
         self.updated.emit(self)
 
-    #
-    #
-    #
+    @handler("ping")
+    def on_ping(self, args: str):
+        self.send_cmd("pong")
+
+    @handler("time")
+    def on_time(self, args: str):
+        self.dtime = parse_time(args.split(","))
+        self.dtime_changed = True
+        return self.dtime
+
+    @handler("battery")
+    def on_battery(self, args: str):
+        self.set_battery(int(args))
+        return self.battery
+
+    @handler("firmware")
+    def on_firmware(self, args: str):
+        if args != self.firmware:
+            self.firmware = args
+            self.firmware_changed = True
+
+        return self.firmware
+
+    @handler("features")
+    def on_features(self, args: str):
+        self.features = set(args.split(","))
+        return self.features
+
+    @handler("statuspush")
+    def on_statuspush(self, args: str):
+        return int(args)
+
+    @handler("getsettings")
+    def on_getsettings(self, args: str):
+        split = args.split(",")
+        self.settings = (int(split[0]), int(split[1]))
+        self.settings_changed = True
+        return self.settings
+
+    @handler("setsettings")
+    def on_setsettings(self, args: str):
+        if args == "ok":
+            self.send_cmd("getsettings")
+            return True
+
+        return False
+
+    @handler("imudata")
+    def on_imudata(self, args: str):
+        ax, ay, az, gx, gy, gz = args.split(",")
+        self.set_imu((float(ax), float(ay), float(az)), (float(gx), float(gy), float(gz)))
+        self._poll_telemetry()
+        return self.imu_acceleration, self.imu_gyro
+
+    @handler("imustream")
+    def on_imustream(self, args: str):
+        # The rate the firmware streams at, 0 once unsubscribed
+        return int(args)
+
+    @handler("imus")
+    def on_imus(self, args: str):
+        if self.telemetry is None:
+            return 0
+
+        count = self.telemetry.extend_text(args)
+        last = self.telemetry.last()
+        self.set_imu(tuple(last[1:4]), tuple(last[4:7]))
+        self.telemetry_changed = True
+        return count
+
+    @handler("info")
+    def on_info(self, args: str):
+        split = args.split(",")
+
+        self.set_battery(int(split[0]))
+        self.dtime = parse_time(split[1:7])
+        self.dtime_changed = True
+        self.set_imu((float(split[7]), float(split[8]), float(split[9])),
+                     (float(split[10]), float(split[11]), float(split[12])))
+        self._poll_telemetry()
+        return self.battery, self.dtime, self.imu_acceleration, self.imu_gyro
+
+    def _poll_telemetry(self):
+        # Without the 'stream' feature, the polled readings are all there is
+        if self.telemetry_rate > 0 and "stream" not in self.features:
+            self.telemetry.append((asyncio.get_event_loop().time(),) + self.imu_acceleration + self.imu_gyro)
+            self.telemetry_changed = True
+
+    @handler("alarm")
+    def on_alarm(self, args: str):
+        split = args.split(",")[1:]  # ignore 'all'
+        self.alarms = [Alarm(int(split[i * 4 + 1]), int(split[i * 4 + 2]), int(split[i * 4 + 3]),
+                             split[i * 4 + 0] == '1') for i in range(12)]
+        self.alarms_changed = True
+        return list(self.alarms)
+
+    @handler("alarmSET")
+    def on_alarm_set(self, args: str):
+        if args == "OK":
+            self.send_cmd("alarmGET")
+            return True
+
+        return False
+
+    @handler("delfolder")
+    def on_delfolder(self, args: str):
+        ok = args.split(",")[0] == "ok"
+
+        if ok:
+            self.folders = [i for i in self.folders if i.name != self.folder_pending_delete]
+            self.folders_changed = True
+            self.scanner.listings.put(self.ble.address, self.folders)
+        else:
+            print('Fail')
+
+        self.folder_pending_delete = ""
+        return ok
+
+    @handler("gnfolders")
+    def on_gnfolders(self, args: str):
+        split = args.split(",")
+
+        # Built aside, self.folders keeps the previous listing until this one is complete
+        self.folders_listing = [None] * int(split[1])
+        if len(self.folders_listing) > 0:
+            self.send_cmd("getnamefolders:*")
+        else:
+            self._list_folder_files(0)
+
+        return len(self.folders_listing)
+
+    @handler("namefolder")
+    def on_namefolder(self, args: str):
+        _, folderId, name = args.split(",", 2)
+        folderId = int(folderId)
+        folders = self.folders_listing
+
+        self.set_folders_status((folderId + 1) / len(folders) * 0.5,
+                                f"Received folder {name} {folderId + 1}/{len(folders)}")
+
+        folders[folderId] = LogFolder(name, [])
+
+        if folderId + 1 < len(folders):
+            self.send_cmd("getnamefolders:*")
+        else:
+            self._list_folder_files(0)
+
+        return name
+
+    @handler("gnfiles")
+    def on_gnfiles(self, args: str):
+        split = args.split(",")
+        folder = self.folders_listing[self.folders_index]
+        count = int(split[1])
+
+        # Folders whose file count did not change are taken from the previous listing
+        known = next((i for i in self.folders if i.name == folder.name), None)
+        if known is not None and len(known.children) == count:
+            folder.children = list(known.children)
+            self._list_folder_files(self.folders_index + 1)
+            return count
+
+        folder.children = [None] * count
+        if count > 0:
+            self.send_cmd(f"getnamefiles:*")
+        else:
+            self._list_folder_files(self.folders_index + 1)
+
+        return count
+
+    @handler("namefiles")
+    def on_namefiles(self, args: str):
+        _, fileId, name = args.split(",", 2)
+        fileId = int(fileId)
+        folder = self.folders_listing[self.folders_index]
+
+        self.set_folders_status(0.5 + (self.folders_index + (fileId + 1) / len(folder.children)) /
+                                len(self.folders_listing) * 0.5,
+                                f"Received file {fileId + 1}/{len(folder.children)} of {folder.name}")
+
+        folder.children[fileId] = LogFile(name)
+
+        if fileId + 1 < len(folder.children):
+            self.send_cmd(f"getnamefiles:*")
+        else:
+            self._list_folder_files(self.folders_index + 1)
+
+        return name
+
+    @handler("tree")
+    def on_tree(self, args: str):
+        # Folder name, file count and then every file name
+        name, count, *files = args.split(",")
+        self.folders_listing.append(LogFolder(name, [LogFile(file) for file in files]))
+
+        self.set_folders_status(0.5, f"Received folder {name} with {count} files")
+        return name
+
+    @handler("treeend")
+    def on_treeend(self, args: str):
+        self._list_folder_files(len(self.folders_listing))
+        return len(self.folders)
+
+    def _list_folder_files(self, index: int):
+        self.folders_index = index
+
+        if index < len(self.folders_listing):
+            self.send_cmd(f"gnfiles:{self.folders_listing[index].name},*")
+            return
 
-    async def handle_rx(self, _: int, data: bytearray):
-        command = data.decode()
-        # print("RX: " + command + " - " + ("".join("{:02x} ".format(x) for x in data)))
+        self.folders = self.folders_listing
+        self.folders_listing = []
+        self.folders_pending = False
+        self.folders_changed = True
+        self.set_folders_status(1, f"Listed {len(self.folders)} folders")
+
+        self.scanner.listings.put(self.ble.address, self.folders)
+
+        if self.folders_listed is not None and not self.folders_listed.done():
+            self.folders_listed.set_result(self.folders)
+
+    @handler("getslog")
+    def on_getslog(self, args: str):
+        split = args.split(",")
+        self.download_size = int(split[0])
+        self.download_written = self.download_offset
+        self.download_chunks = 0
+        self.download_decoder = None
+        self.set_folders_status(self.download_written / max(self.download_size, 1), self.folders_message)
+
+        if self.download_size == 0:
+            # Missing or empty file, there is nothing to start
+            self.on_endlog("")
+            return self.download_size
+
+        self.download_file_stream.preallocate(self.download_size)
+        self.download_windowed = "window" in self.features and self.download_window > 1
+        window = self.download_window if self.download_windowed else 1
+
+        if self.download_encoding is not None and self.download_encoding in self.features:
+            self.download_decoder = ZlibDecoder()
+            self.send_cmd(f"startlog:{window},{self.download_offset},{self.download_encoding},*")
+        elif self.download_offset > 0:
+            self.send_cmd(f"startlog:{window},{self.download_offset},*")
+        elif self.download_windowed:
+            self.send_cmd(f"startlog:{window},*")
+        else:
+            self.send_cmd(f"startlog:*")
+
+        return self.download_size
+
+    @handler("getflog")
+    def on_getflog(self, args: str):
+        # Payload followed by a 4 char trailer: ',' + sequence number + '*'
+        payload = args[:-4]
+        if self.download_decoder is not None:
+            payload = self.download_decoder.decode(payload)
 
-        result = command.find('\n')
+        try:
+            written = self.download_file_stream.write(payload)
+        except OSError as ex:
+            self._abort_download(ex)
+            return
 
-        while result != -1:
-            self.read_buffer += command[0:result]
+        self.download_written = self.download_written + written
+        self.metrics.downloaded(written)
+
+        self.download_chunks = self.download_chunks + 1
+
+        ack = None
+        if not self.download_windowed:
+            ack = f"getflog:ok,*"
+        elif self.download_chunks % max(self.download_window // 2, 1) == 0:
+            # Cumulative ack, carrying the sequence number of the last chunk received
+            ack = f"getflog:ack,{args[-3:-1]},*"
+
+        if ack is not None:
+            if self.download_file_stream.congested:
+                # The disk is falling behind, hold the ack back so the firmware waits for it
+                asyncio.ensure_future(self._ack_when_drained(self.download_file_stream, ack))
+            else:
+                self.send_cmd(ack)
+
+        self.set_folders_status(self.download_written / self.download_size,
+                                f"{human_readable_size(self.download_written)}/{human_readable_size(self.download_size)}")
+
+    @handler("endlog")
+    def on_endlog(self, args: str):
+        if self.download_decoder is not None:
+            tail = self.download_decoder.flush()
+            self.download_decoder = None
 
             try:
-                await self.receive_cmd(self.read_buffer)
-            except Exception:
+                self.download_written = self.download_written + self.download_file_stream.write(tail)
+            except OSError:
+                # Reported once the writer is closed
                 pass
 
-            self.read_buffer = ''
+        # The next file starts once this one is flushed and synced to disk
+        self.download_file_stream.close().add_done_callback(self._download_closed)
+
+    def _download_closed(self, closed: Future):
+        if closed.exception() is not None:
+            self._abort_download(closed.exception())
+            return
+
+        self.set_folders_status(self.folders_progress, 'Finished!')
+
+        if len(self.download_folder_files) > 0:
+            self.download_file(self.download_folder_name, self.download_folder_files[0],
+                               os.path.join(self.download_folder_path,
+                                            self.file_name(self.download_folder_name, self.download_folder_files[0])))
+        elif self.download_done is not None and not self.download_done.done():
+            self.download_done.set_result(self.download_written)
+
+        # Runs once the writer is done, after the line that ended the download was handled
+        self.updated.emit(self)
 
-            command = command[result:-1]
-            result = command.find('\n')
+    def _abort_download(self, error: Exception):
+        print(f"Download to {self.download_file_stream.path} failed: {error}")
 
-        self.read_buffer += command
+        self.download_file_stream.close()
+        self.download_folder_files = []
+        self.set_folders_status(self.folders_progress, 'Failed!')
+
+        if self.download_done is not None and not self.download_done.done():
+            self.download_done.set_exception(error)
+            self.download_done.exception()
+
+        self.updated.emit(self)
+
+    async def _ack_when_drained(self, stream: FileWriter, ack: str):
+        await stream.drained()
+
+        if self.running and stream is self.download_file_stream:
+            self.send_cmd(ack)
 
     #
     #
     #
 
-    def handle_disconnect(self, _: BleakClient):
+    async def handle_rx(self, _: int, data: bytearray):
+        if self.trace is not None:
+            self.trace.record(RX, data)
+
+        self.metrics.count('frames_received')
+        self.metrics.count('bytes_received', len(data))
+
+        for frame in self.framer.feed(data):
+            try:
+                await self.receive_cmd(frame)
+            except Exception as ex:
+                print(ex)
+
+    #
+    #
+    #
+
+    def handle_disconnect(self, _: 'BleakClient'):
         self.running = False
         print("Device was disconnected, goodbye.")
 
+        self._stop_writer()
+
         if self.ble.address in self.scanner.devices:
             self.scanner.device_disconnected.emit(self)
 
-    async def _sleep(self, _time: float):
-        await asyncio.sleep(_time)
+    def _stop_writer(self):
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+            self.writer_task = None
 
-        if len(self.queued_commands) > 0:
-            for i in range(len(self.queued_commands)):
-                command = self.queued_commands[0]
-                await self._send_cmd(command)
-                self.queued_commands.remove(command)
-                await asyncio.sleep(_time)
+        if self.download_file_stream is not None and not self.download_file_stream.closed:
+            # Keep what was received, an interrupted download can resume from it
+            self.download_file_stream.close()
+
+        self._fail_requests(BleakError(f"Device {self.name} was disconnected"))
+
+        if self.trace is not None:
+            print(f"Recorded {self.trace.entries} packets to {self.trace.path}")
+            self.trace.close()
+            self.trace = None
+
+    async def _query(self, command: str, retries: int = HANDSHAKE_RETRIES):
+        for attempt in range(retries):
+            try:
+                return await self.request(command, timeout=HANDSHAKE_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f"No reply to {command} from {self.name}, attempt {attempt + 1} of {retries}")
+
+                if attempt + 1 < retries:
+                    self.metrics.count('request_retries')
+
+        return None
+
+    async def _handshake(self):
+        # Firmware without protocol extensions does not answer 'features' at all
+        features = asyncio.ensure_future(self._query("features", retries=1))
+
+        try:
+            await asyncio.gather(*[self._query(command) for command in HANDSHAKE])
+        finally:
+            # Replies come back in order, the features would have been listed by now
+            features.cancel()
+            await asyncio.gather(features, return_exceptions=True)
+
+    def _update_status_push(self, interval):
+        push = 0 if interval is None else round(interval * 1000)
+
+        if push != self.status_push:
+            self.status_push = push
+            self.send_cmd(f"statuspush:{push},*")
 
     async def run(self):
-        tick = 0
         tick_duration = 0.2
+        loop = asyncio.get_event_loop()
 
         self.folders_disabled = True
+        self.folders_status_changed = True
 
-        await self._sleep(tick_duration * 2)
-        await self._send_cmd("info")
-        await self._sleep(tick_duration * 2)
-        await self._send_cmd("getsettings")
-        await self._sleep(tick_duration * 2)
-        await self._send_cmd("alarmGET")
-        await self._sleep(tick_duration * 2)
-        await self._send_cmd("firmware")
-        await self._sleep(tick_duration * 2)
-        await self._send_cmd("alarmGET")
-        await self._sleep(tick_duration * 2)
+        try:
+            await self._handshake()
+        except BleakError:
+            # Disconnected before it was done
+            return
 
         self.folders_disabled = False
+        self.folders_status_changed = True
+        self.ready.set()
+        self.updated.emit(self)
 
+        if self.telemetry_rate > 0:
+            # Subscribed before the link dropped
+            self.start_telemetry(self.telemetry_rate)
+
+        polled = loop.time()
         while self.running:
-            # await self._send_cmd("info")
-            await self._sleep(tick_duration)
+            interval = self.poll_interval()
+
+            if "status" in self.features:
+                # Firmware pushes changes as they happen, and the status at least this often
+                self._update_status_push(interval)
+                poll = False
+            else:
+                poll = interval is not None and loop.time() - polled >= interval
 
-            if tick % 10 == 0:
-                await self._send_cmd("info")
-                await self._sleep(tick_duration)
+            # Live telemetry without the 'stream' feature polls every tick
+            if poll or (self.telemetry_rate > 0 and "stream" not in self.features):
+                self.send_cmd("info")
+                polled = loop.time()
 
-            tick = tick + 1
+            await asyncio.sleep(tick_duration)
 
     #
     #
     #
 
+    async def acquire(self):
+        """ Connect and start the session, unless another user already has """
+        self.users = self.users + 1
+
+        if self.running:
+            return
+
+        try:
+            await self.connect_device()
+        except Exception:
+            self.users = self.users - 1
+            raise
+
+        self.runtask = asyncio.get_event_loop().create_task(self.run())
+
+    async def release(self):
+        """ Disconnect once the last user of the session is done with it """
+        self.users = max(self.users - 1, 0)
+
+        if self.users > 0:
+            return
+
+        if self.runtask is not None:
+            self.runtask.cancel()
+            self.runtask = None
+
+        await self.disconnect_device()
+
     async def connect_device(self):
         if self.running:
             return
 
         print("Connecting device " + self.name)
+        load_bleak()
 
         self.running = True
-        self.client = BleakClient(self.ble, disconnected_callback=self.handle_disconnect)
+        self.metrics.count('connects')
+        self.ready = asyncio.Event()
+        self.features = set()
+        self.status_push = None
+        self.framer.reset()
+        self.command_queue = asyncio.Queue()
+
+        if self.scanner.trace_directory is not None:
+            self.trace = TraceRecorder(trace_path(self.scanner.trace_directory, self.ble.address),
+                                       {'address': self.ble.address, 'name': self.name, 'started': time.time()})
 
         self.updated.emit(self)
 
-        await self.client.connect()
-        await self.client.start_notify(UART_CHAR_UUID, self.handle_rx)
-        await self._send_cmd('pong')
+        try:
+            # Known devices added without scanning are connected to by address
+            target = self.ble if self.ble.details is not None else self.ble.address
+            client_class = self.scanner.client_class or BleakClient
+            self.client = client_class(target, disconnected_callback=self.handle_disconnect)
+
+            await self.client.connect()
+            await self._negotiate_write()
+            await self.client.start_notify(UART_CHAR_UUID, self.handle_rx)
+        except Exception:
+            # Not connected after all, the next acquire tries again
+            await self._abort_connect()
+            raise
+
+        self.writer_task = asyncio.get_event_loop().create_task(self._writer())
+        self.send_cmd('pong')
+
+    async def _abort_connect(self):
+        client = self.client
+
+        self.running = False
+        self.command_queue = None
+        self.client = None
+        self._stop_writer()
+
+        try:
+            if client is not None and client.is_connected:
+                await client.disconnect()
+        except Exception as ex:
+            print(f"Could not disconnect {self.name}: {ex}")
+
+        self.updated.emit(self)
 
     async def disconnect_device(self):
         if not self.running:
@@ -378,6 +1108,8 @@ class Device(QObject):
         self.running = False
         self.scanner.device_disconnecting.emit(self)
 
+        self._stop_writer()
+
         if self.client.is_connected:
             await self.client.disconnect()
 
@@ -385,9 +1117,19 @@ class Device(QObject):
             self.scanner.device_disconnected.emit(self)
 
 
-class Scanner(QObject):
+class Scanner:
     devices = {}
 
+    # BleakScanner and BleakClient when None
+    scanner_class = None
+    client_class = None
+
+    max_connections = MAX_CONNECTIONS
+    pool_size = POOL_SIZE
+    pool_idle_timeout = POOL_IDLE_TIMEOUT
+    # Every connection is recorded to a protocol trace in this directory, when set
+    trace_directory: str = None
+
     scanning = False
 
     scan_started = Signal()
@@ -397,53 +1139,92 @@ class Scanner(QObject):
     disconnect_finished = Signal()
 
     device_found = Signal(Device)
+    # Advertised again, with a new RSSI or name
+    device_seen = Signal(Device)
     device_disconnecting = Signal(Device)
     device_disconnected = Signal(Device)
 
-    def __init__(self):
-        QObject.__init__(self)
+    def __init__(self, scanner_class=None, client_class=None, listings: ListingCache = None,
+                 known: KnownDevices = None):
+        self.devices = {}
+        self.scanner_class = scanner_class
+        self.client_class = client_class
+        self.listings = listings or ListingCache()
+        self.known = known or KnownDevices()
+
+    def add_known_devices(self) -> List[Device]:
+        """ Report the loggers seen on earlier runs, they can be connected to by address without scanning """
+        load_bleak()
+
+        devices = []
+        for address, name in self.known.names().items():
+            if address in self.devices:
+                continue
+
+            # No signal strength until it is seen advertising
+            device = Device(self, BLEDevice(address, name, rssi=-127))
+            self.devices[address] = device
+            self.device_found.emit(device)
+            devices.append(device)
+
+        return devices
+
+    async def scan_ble_devices(self, duration: float = SCAN_TIME, targets: Set[str] = None):
+        """
+        Scan for loggers for up to `duration` seconds. Each one is reported
+        through device_found as soon as it is first seen, and through
+        device_seen when it advertises again. The scan stops early once
+        every address in `targets` was found.
+        """
+        if self.scanning:
+            return
 
-    async def scan_ble_devices(self):
-        try:
-            if self.scanning:
-                return
+        print("Scanning for devices")
+        self.scanning = True
+        self.scan_started.emit()
 
-            print("Scanning for devices")
-            self.scanning = True
-            self.scan_started.emit()
+        targets = {address.upper() for address in targets or []}
+        found = asyncio.Event()
 
-            devices = {}
+        def on_detect(_device: 'BLEDevice', adv: 'AdvertisementData'):
+            device = self.devices.get(_device.address)
 
-            async def on_detect(_device: BLEDevice, adv: AdvertisementData):
-                if _device.address in devices:
-                    if len(_device.name) > 0:
-                        devices[_device.address] = _device
+            if device is not None:
+                if device.update_advertisement(_device):
+                    self.known.add(_device.address, device.name)
+                    self.device_seen.emit(device)
 
-                    return
+                return
 
-                if UART_SERVICE_UUID.lower() not in adv.service_uuids:
-                    return
+            # Filtered by the OS where the backend supports it, not every one does
+            if UART_SERVICE_UUID.lower() not in adv.service_uuids:
+                return
 
-                devices[_device.address] = _device
+            device = Device(self, _device)
+            self.devices[_device.address] = device
+            self.known.add(_device.address, device.name)
+            self.device_found.emit(device)
 
-            async with BleakScanner(detection_callback=on_detect):
-                await asyncio.sleep(5.0)
+            if len(targets) > 0 and targets <= {address.upper() for address in self.devices}:
+                found.set()
 
-            print(self.devices.keys())
-            for address, ble in devices.items():
-                device = Device(self, ble)
-                if address in self.devices:
-                    continue
+        try:
+            load_bleak()
+            scanner_class = self.scanner_class or BleakScanner
 
-                self.devices[address] = device
-                self.device_found.emit(device)
+            async with scanner_class(detection_callback=on_detect, service_uuids=[UART_SERVICE_UUID],
+                                     filters={"UUIDs": [UART_SERVICE_UUID]}):
+                try:
+                    await asyncio.wait_for(found.wait(), duration)
+                except asyncio.TimeoutError:
+                    pass
 
             print("Finished scanning")
-
-            self.scanning = False
-            self.scan_finished.emit()
         except Exception as ex:
             print(ex)
+        finally:
+            self.scanning = False
+            self.scan_finished.emit()
 
     #
     #
@@ -0,0 +1,87 @@
+import asyncio
+import os
+from typing import Dict, List
+
+from ble import Device, MAX_CONNECTIONS
+from ble.signals import Signal
+
+# Seconds to wait for the connection handshake, and for the listing of the files
+FLEET_READY_TIMEOUT = 30.0
+FLEET_LIST_TIMEOUT = 60.0
+
+
+class FleetDownload:
+    """
+    Downloads every file of every given device into `target_path`. Devices
+    are worked on in parallel, at most `max_connections` at a time.
+    """
+
+    progress = Signal(Device)
+    finished = Signal()
+
+    def __init__(self, devices: List[Device], target_path: str, max_connections: int = MAX_CONNECTIONS,
+                 device_directories: bool = False):
+        self.devices = devices
+        self.target_path = target_path
+        self.max_connections = max_connections
+        # Files of each device in their own directory, named after the address, as names need not be unique
+        self.device_directories = device_directories
+
+        self.files_total: Dict[Device, int] = {device: 0 for device in devices}
+        self.files_done: Dict[Device, int] = {device: 0 for device in devices}
+        self.bytes_done: Dict[Device, int] = {device: 0 for device in devices}
+        self.errors: Dict[Device, Exception] = {}
+
+    def describe(self, device: Device) -> str:
+        if device in self.errors:
+            return f"{device.name} - failed: {self.errors[device]}"
+
+        if self.files_total[device] == 0:
+            return f"{device.name} - waiting"
+
+        return f"{device.name} - {self.files_done[device]}/{self.files_total[device]} files"
+
+    def target_directory(self, device: Device) -> str:
+        if not self.device_directories:
+            return self.target_path
+
+        return os.path.join(self.target_path, device.ble.address.replace(':', ''))
+
+    @property
+    def bytes_total(self) -> int:
+        return sum(self.bytes_done.values())
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.max_connections)
+
+        await asyncio.gather(*[self._download_device(device, semaphore) for device in self.devices])
+
+        self.finished.emit()
+
+    async def _download_device(self, device: Device, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            try:
+                await device.acquire()
+
+                try:
+                    await asyncio.wait_for(device.ready.wait(), FLEET_READY_TIMEOUT)
+
+                    target_path = self.target_directory(device)
+                    os.makedirs(target_path, exist_ok=True)
+
+                    folders = await asyncio.wait_for(device.list_folders(), FLEET_LIST_TIMEOUT)
+                    self.files_total[device] = sum(len(folder.children) for folder in folders)
+                    self.progress.emit(device)
+
+                    for folder in folders:
+                        for file in folder.children:
+                            path = os.path.join(target_path, device.file_name(folder.name, file.name))
+                            self.bytes_done[device] += await device.fetch_file(folder.name, file.name, path)
+                            self.files_done[device] += 1
+                            self.progress.emit(device)
+                finally:
+                    await device.release()
+            except Exception as ex:
+                print(f"{device.name}: {ex}")
+                self.errors[device] = ex
+                self.progress.emit(device)
@@ -0,0 +1,72 @@
+import base64
+import codecs
+import zlib
+from typing import List
+
+# Frames longer than this without a newline are garbage, drop them instead of buffering forever
+MAX_FRAME_SIZE = 64 * 1024
+
+
+class LineFramer:
+    """
+    Splits the notification stream into '\\n' terminated frames. Bytes are
+    buffered until a frame is complete, so UTF-8 sequences split across
+    notifications decode correctly, and each byte is only scanned once.
+    """
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.max_frame_size = max_frame_size
+
+    def reset(self):
+        self.buffer.clear()
+        self.scanned = 0
+
+    def feed(self, data) -> List[str]:
+        buffer = self.buffer
+        buffer += data
+
+        frames = []
+        start = 0
+        end = buffer.find(b'\n', self.scanned)
+
+        if end != -1:
+            with memoryview(buffer) as view:
+                while end != -1:
+                    frames.append(str(view[start:end], 'utf-8', 'replace'))
+                    start = end + 1
+                    end = buffer.find(b'\n', start)
+
+            del buffer[:start]
+
+        self.scanned = len(buffer)
+
+        if self.scanned > self.max_frame_size:
+            print(f"Dropping {self.scanned} bytes without a frame terminator")
+            self.reset()
+
+        return frames
+
+
+class ZlibDecoder:
+    """
+    Inflates a log sent as a base64 encoded deflate stream, one getflog
+    payload at a time. Payloads need not be aligned to base64 quanta, the
+    leftover characters are kept for the next one.
+    """
+
+    def __init__(self):
+        self.pending = ''
+        self.inflater = zlib.decompressobj()
+        self.text = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def decode(self, payload: str) -> str:
+        payload = self.pending + payload
+        usable = len(payload) - len(payload) % 4
+        self.pending = payload[usable:]
+
+        return self.text.decode(self.inflater.decompress(base64.b64decode(payload[:usable])))
+
+    def flush(self) -> str:
+        return self.text.decode(self.inflater.flush(), final=True)
@@ -0,0 +1,36 @@
+import json
+import os
+from typing import Dict, List
+
+from utils import LogFile, LogFolder, data_path
+
+
+class ListingCache:
+    """
+    Last folder and file listing of every device, by address, saved to disk
+    so a known device shows its files before it is listed again.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or data_path('listings.json')
+        self.listings: Dict[str, Dict[str, List[str]]] = {}
+
+        try:
+            with open(self.path) as f:
+                self.listings = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as ex:
+            print(f"Could not load listings: {ex}")
+
+    def get(self, address: str) -> List[LogFolder]:
+        listing = self.listings.get(address, {})
+        return [LogFolder(folder, [LogFile(file) for file in files]) for folder, files in listing.items()]
+
+    def put(self, address: str, folders: List[LogFolder]):
+        self.listings[address] = {folder.name: [file.name for file in folder.children] for folder in folders}
+
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.listings, f)
+
+        os.replace(self.path + '.tmp', self.path)
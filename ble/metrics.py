@@ -0,0 +1,200 @@
+import json
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Tuple
+
+# Upper bounds of the round-trip time buckets, in seconds
+RTT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Seconds of download throughput kept, one sample per second
+THROUGHPUT_HISTORY = 300
+# Replies matched to the command that asked for them, at most this late
+REPLY_TIMEOUT = 10.0
+
+COUNTERS = {
+    'bytes_sent': "Bytes written to the UART characteristic",
+    'frames_sent': "Writes to the UART characteristic",
+    'bytes_received': "Bytes notified by the UART characteristic",
+    'frames_received': "Notifications of the UART characteristic",
+    'commands_sent': "Commands sent",
+    'lines_received': "Lines received",
+    'write_retries': "Writes retried after an error",
+    'request_timeouts': "Requests left without a reply",
+    'request_retries': "Requests sent again after a timeout",
+    'connects': "Connections made",
+    'download_bytes': "Log bytes downloaded",
+}
+
+
+class Histogram:
+    """ Observations counted in buckets, like a Prometheus histogram """
+
+    def __init__(self, buckets: Tuple[float, ...] = RTT_BUCKETS):
+        self.buckets = buckets
+        # The last one counts what is above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i = i + 1
+
+        self.counts[i] = self.counts[i] + 1
+        self.count = self.count + 1
+        self.sum = self.sum + value
+
+    def quantile(self, q: float) -> float:
+        """ Upper bound of the bucket holding the q-quantile, inf when above every bucket """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen = seen + count
+            if seen >= rank:
+                return bound
+
+        return float('inf')
+
+    def to_dict(self) -> dict:
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative = cumulative + count
+            buckets[str(bound)] = cumulative
+
+        return {'buckets': buckets, 'count': self.count, 'sum': self.sum}
+
+
+class DeviceMetrics:
+    """
+    Link health of a device over its lifetime, across reconnects: traffic
+    counters, round-trip time of each command, depth of the command queue
+    and download throughput.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counters: Dict[str, int] = dict.fromkeys(COUNTERS, 0)
+        self.rtt: Dict[str, Histogram] = {}
+
+        self.queue_depth = 0
+        self.queue_depth_max = 0
+
+        # Send time of commands awaiting a reply, by the name of the reply
+        self.awaiting: Dict[str, Deque[Tuple[str, float]]] = {}
+        # [second since started, bytes] of the latest seconds with downloads
+        self.throughput: Deque[List[int]] = deque(maxlen=THROUGHPUT_HISTORY)
+
+    def count(self, counter: str, value: int = 1):
+        self.counters[counter] = self.counters[counter] + value
+
+    def queued(self, depth: int):
+        self.queue_depth = depth
+        self.queue_depth_max = max(self.queue_depth_max, depth)
+
+    def command_sent(self, command: str, reply: str = None):
+        """ Counts the command, and times it until `reply` is received """
+        self.count('commands_sent')
+
+        if reply is not None:
+            self.awaiting.setdefault(reply, deque(maxlen=16)).append((command, time.monotonic()))
+
+    def line_received(self, reply: str):
+        self.count('lines_received')
+
+        awaiting = self.awaiting.get(reply)
+        now = time.monotonic()
+        while awaiting:
+            command, sent = awaiting.popleft()
+            if now - sent <= REPLY_TIMEOUT:
+                self.rtt.setdefault(command, Histogram()).observe(now - sent)
+                return
+
+    def downloaded(self, size: int):
+        self.count('download_bytes', size)
+
+        second = int(time.monotonic() - self.started)
+        if len(self.throughput) > 0 and self.throughput[-1][0] == second:
+            self.throughput[-1][1] += size
+        else:
+            self.throughput.append([second, size])
+
+    def download_rate(self, window: int = 5) -> float:
+        """ Bytes per second downloaded over the last `window` seconds """
+        since = int(time.monotonic() - self.started) - window
+        return sum(size for second, size in self.throughput if second >= since) / window
+
+    def summary(self) -> List[Tuple[str, str]]:
+        """ Name and value of every metric, formatted for display """
+        rows = [(name.replace('_', ' ').capitalize(), str(value)) for name, value in self.counters.items()]
+        rows.append(("Queue depth (max)", f"{self.queue_depth} ({self.queue_depth_max})"))
+        rows.append(("Download rate", f"{self.download_rate() / 1024:.1f} KiB/s"))
+
+        for command, histogram in sorted(self.rtt.items()):
+            rows.append((f"RTT {command} p50/p95", f"{histogram.quantile(0.5) * 1000:g}/"
+                                                   f"{histogram.quantile(0.95) * 1000:g} ms ({histogram.count})"))
+
+        return rows
+
+    def to_dict(self) -> dict:
+        return {
+            'uptime': time.monotonic() - self.started,
+            'counters': dict(self.counters),
+            'queue_depth': self.queue_depth,
+            'queue_depth_max': self.queue_depth_max,
+            'rtt': {command: histogram.to_dict() for command, histogram in self.rtt.items()},
+            'download_rate': self.download_rate(),
+            'throughput': [list(sample) for sample in self.throughput],
+        }
+
+
+#
+#
+#
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def to_json(devices: Iterable[Tuple[Dict[str, str], DeviceMetrics]]) -> str:
+    return json.dumps([dict(labels, metrics=metrics.to_dict()) for labels, metrics in devices], indent=1)
+
+
+def to_prometheus(devices: Iterable[Tuple[Dict[str, str], DeviceMetrics]]) -> str:
+    """ Prometheus text exposition of the metrics of every device, labelled with its `labels` """
+    devices = list(devices)
+    lines = []
+
+    for name, description in COUNTERS.items():
+        lines.append(f"# HELP bbq_{name}_total {description}")
+        lines.append(f"# TYPE bbq_{name}_total counter")
+        lines.extend(f"bbq_{name}_total{_labels(labels)} {metrics.counters[name]}" for labels, metrics in devices)
+
+    for name, description, value in [('queue_depth', "Commands waiting to be written", lambda m: m.queue_depth),
+                                     ('queue_depth_max', "Most commands ever waiting", lambda m: m.queue_depth_max),
+                                     ('download_rate_bytes', "Bytes per second downloaded lately",
+                                      lambda m: m.download_rate())]:
+        lines.append(f"# HELP bbq_{name} {description}")
+        lines.append(f"# TYPE bbq_{name} gauge")
+        lines.extend(f"bbq_{name}{_labels(labels)} {value(metrics):g}" for labels, metrics in devices)
+
+    lines.append("# HELP bbq_command_rtt_seconds Time from writing a command to its reply")
+    lines.append("# TYPE bbq_command_rtt_seconds histogram")
+    for labels, metrics in devices:
+        for command, histogram in sorted(metrics.rtt.items()):
+            command_labels = dict(labels, command=command)
+
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative = cumulative + count
+                lines.append(f"bbq_command_rtt_seconds_bucket{_labels(dict(command_labels, le=f'{bound:g}'))} {cumulative}")
+
+            lines.append(f"bbq_command_rtt_seconds_bucket{_labels(dict(command_labels, le='+Inf'))} {histogram.count}")
+            lines.append(f"bbq_command_rtt_seconds_sum{_labels(command_labels)} {histogram.sum:g}")
+            lines.append(f"bbq_command_rtt_seconds_count{_labels(command_labels)} {histogram.count}")
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,107 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict
+
+from ble import Device, POOL_IDLE_TIMEOUT, POOL_SIZE
+from ble.signals import Signal
+
+
+class ConnectionPool:
+    """
+    Recently used devices kept connected, so switching back to one only
+    needs the widgets rebound. At most `size` are open; the least recently
+    used is released first, and any left in the background for
+    `idle_timeout` seconds. Background devices poll less often.
+    """
+
+    opened = Signal(Device)
+    closed = Signal(Device)
+
+    active: Device = None
+    reaper: asyncio.Task = None
+
+    def __init__(self, size: int = POOL_SIZE, idle_timeout: float = POOL_IDLE_TIMEOUT):
+        self.size = max(size, 1)
+        self.idle_timeout = idle_timeout
+
+        # Devices by the time they were last active, least recently used first
+        self.sessions: Dict[Device, float] = OrderedDict()
+
+    def __contains__(self, device: Device) -> bool:
+        return device in self.sessions
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    async def activate(self, device: Device):
+        """ Bring the device to the foreground, connecting unless it is still pooled """
+        self.deactivate()
+
+        if device in self.sessions and not device.running:
+            # The link dropped while in the background
+            await self._release(device)
+
+        if device not in self.sessions:
+            await self.trim(self.size - 1)
+            await device.acquire()
+
+            self.sessions[device] = time.monotonic()
+            self.opened.emit(device)
+
+        self.sessions.move_to_end(device)
+        self.active = device
+        device.set_background(False)
+
+        if self.reaper is None and self.idle_timeout > 0:
+            self.reaper = asyncio.get_event_loop().create_task(self._expire())
+
+    def deactivate(self):
+        """ Move the foreground device to the background, it stays connected """
+        if self.active is None:
+            return
+
+        if self.active in self.sessions:
+            self.sessions[self.active] = time.monotonic()
+            self.active.set_background(True)
+
+        self.active = None
+
+    async def remove(self, device: Device):
+        """ Disconnect the device now, even when it is in the foreground """
+        if device is self.active:
+            self.active = None
+
+        if device in self.sessions:
+            await self._release(device)
+
+    async def trim(self, keep: int):
+        for device in list(self.sessions):
+            if len(self.sessions) <= keep:
+                break
+
+            if device is not self.active:
+                await self._release(device)
+
+    async def close(self):
+        if self.reaper is not None:
+            self.reaper.cancel()
+            self.reaper = None
+
+        self.active = None
+        await self.trim(0)
+
+    async def _release(self, device: Device):
+        self.sessions.pop(device, None)
+        self.closed.emit(device)
+        await device.release()
+
+    async def _expire(self):
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 4, 0.01))
+
+            now = time.monotonic()
+            for device, used in list(self.sessions.items()):
+                if device is not self.active and (now - used > self.idle_timeout or not device.running):
+                    print(f"Closing idle connection to {device.name}")
+                    await self._release(device)
@@ -0,0 +1,53 @@
+import json
+import os
+import time
+from typing import Dict
+
+from utils import data_path
+
+
+class KnownDevices:
+    """
+    Address and name of every logger seen, saved to disk so they can be
+    listed and connected to by address on the next run, without scanning.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or data_path('devices.json')
+        self.devices: Dict[str, Dict[str, object]] = {}
+
+        try:
+            with open(self.path) as f:
+                self.devices = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as ex:
+            print(f"Could not load known devices: {ex}")
+
+    def __contains__(self, address: str) -> bool:
+        return address in self.devices
+
+    def names(self) -> Dict[str, str]:
+        """ Name of every known device, by address, most recently seen first """
+        ordered = sorted(self.devices.items(), key=lambda i: i[1].get('seen', 0), reverse=True)
+        return {address: device['name'] for address, device in ordered}
+
+    def add(self, address: str, name: str):
+        known = self.devices.get(address)
+
+        # Only written when something changed, or once a day to keep 'seen' roughly current
+        if known is not None and known['name'] == name and time.time() - known.get('seen', 0) < 24 * 3600:
+            return
+
+        self.devices[address] = {'name': name, 'seen': int(time.time())}
+        self.save()
+
+    def remove(self, address: str):
+        if self.devices.pop(address, None) is not None:
+            self.save()
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.devices, f, indent=1)
+
+        os.replace(self.path + '.tmp', self.path)
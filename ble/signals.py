@@ -0,0 +1,50 @@
+from typing import Callable, List
+
+
+class Signal:
+    """
+    Stand-in for Qt signals, so the protocol core runs without Qt. Declared
+    as a class attribute like a Qt Signal; every instance gets its own list
+    of slots, called directly on emit as a Qt direct connection would.
+    """
+
+    def __init__(self, *types):
+        self.types = types
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        bound = instance.__dict__.get(self.name)
+        if bound is None:
+            bound = instance.__dict__[self.name] = BoundSignal()
+
+        return bound
+
+
+class BoundSignal:
+    def __init__(self):
+        self.slots: List[Callable] = []
+
+    def connect(self, slot: Callable):
+        self.slots.append(slot)
+
+    def disconnect(self, slot: Callable = None):
+        if slot is None:
+            self.slots.clear()
+        elif slot in self.slots:
+            self.slots.remove(slot)
+        else:
+            raise RuntimeError(f"{slot} is not connected")
+
+    def emit(self, *args):
+        for slot in list(self.slots):
+            # As with Qt, a failing slot does not stop the emitter
+            try:
+                slot(*args)
+            except Exception as ex:
+                print(ex)
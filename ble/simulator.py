@@ -0,0 +1,579 @@
+"""
+Simulated logger firmware and a fake bleak backend speaking the UART text
+protocol, so the BLE code can be exercised and benchmarked without hardware.
+
+    backend = SimulatedBackend([SimulatedLogger('AA:00:00:00:00:01')])
+    scanner = Scanner(scanner_class=backend.scanner_class, client_class=backend.client_class)
+"""
+
+import asyncio
+import base64
+import functools
+import random
+import zlib
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from bleak import BleakError
+from bleak.backends.device import BLEDevice
+from bleak.backends.scanner import AdvertisementData
+
+from ble import UART_SERVICE_UUID, UART_CHAR_UUID
+from utils import Alarm
+
+UART_CHAR_HANDLE = 0x0e
+# Seconds between the batches of streamed IMU samples
+STREAM_INTERVAL = 0.05
+
+
+@dataclass
+class LinkProfile:
+    # ATT MTU negotiated on connection, payloads are limited to mtu - 3
+    mtu: int = 23
+    # One-way latency of a packet, in seconds
+    latency: float = 0.015
+    # Usable throughput per direction, in bytes per second
+    bandwidth: int = 10 * 1024
+    # Time spent establishing the connection, in seconds
+    connect_time: float = 0.1
+    # Delay between advertisements of different loggers while scanning, in seconds
+    advertise_interval: float = 0.01
+    # Whether the UART characteristic accepts writes without response
+    write_without_response: bool = True
+    # Drop the connection after notifying this many bytes on it, 0 never drops
+    drop_after: int = 0
+    # The firmware misses every n-th command, as when its input buffer overflows, 0 misses none
+    ignore_every: int = 0
+
+
+class SimulatedLogger:
+    """
+    Firmware state of a single logger. Every line received from the host is
+    answered by `handle`, which returns the lines to notify back.
+
+    `features` lists the protocol extensions the firmware advertises through
+    the 'features' command. Firmware without any behaves like the original
+    one and ignores the command.
+    """
+
+    FEATURES = ('window', 'offset', 'batch', 'zlib', 'stream', 'status')
+
+    def __init__(self, address: str, name: str = 'BBQ', folders: int = 4, files: int = 3,
+                 log_size: int = 64 * 1024, chunk_size: int = 128, firmware: str = '1.0.0', seed: int = 0,
+                 features=FEATURES):
+        self.address = address
+        self.name = name
+        self.firmware = firmware
+        self.features = tuple(features)
+        self.log_size = log_size
+        self.chunk_size = chunk_size
+        self.rssi = -40 - seed % 50
+
+        self.random = random.Random(seed)
+
+        self.battery = 398
+        self.settings = (1, 0)
+        self.alarms = [Alarm() for _ in range(12)]
+
+        self.tree: Dict[str, Dict[str, Optional[str]]] = {}
+        start = datetime(2021, 7, 1, 11, 38, 9)
+        for i in range(folders):
+            folder = start.replace(minute=(start.minute + i) % 60, hour=(start.hour + i // 60) % 24)
+            self.tree[folder.strftime('%d%m%y_%H%M%S')] = {f'{j:03d}': None for j in range(files)}
+
+        self.folder_cursor = 0
+        self.file_folder = None
+        self.file_cursor = 0
+
+        self.log: Optional[str] = None
+        # What is sent of the log, in the encoding requested by startlog
+        self.log_stream: Optional[str] = None
+        self.log_offset = 0
+        self.log_window = 1
+        self.log_sent = 0
+        self.log_acked = 0
+
+        # IMU samples per second streamed to the host, 0 when not streaming
+        self.stream_rate = 0
+        self.stream_millis = 0
+        self.stream_due = 0.0
+
+        # Milliseconds between status pushes, 0 when not pushing
+        self.push_interval = 0
+        self.push_due = 0.0
+        self.pushed_battery = None
+
+        # Commands handled so far, by name
+        self.received: Dict[str, int] = {}
+
+        self.handlers: Dict[str, Callable[[str], List[str]]] = {
+            'pong': lambda arg: [],
+            'ping': lambda arg: ['pong'],
+            'info': self.handle_info,
+            'battery': lambda arg: [f'battery:{self.battery}'],
+            'firmware': lambda arg: [f'firmware:{self.firmware}'],
+            'features': lambda arg: [f'features:{",".join(self.features)}'] if self.features else [],
+            'synctime': self.handle_synctime,
+            'getsettings': lambda arg: [f'getsettings:{self.settings[0]},{self.settings[1]}'],
+            'setsettings': self.handle_setsettings,
+            'imureset': lambda arg: [self.imudata()],
+            'imucalib': lambda arg: [self.imudata()],
+            'alarmGET': self.handle_alarm_get,
+            'alarmSET': self.handle_alarm_set,
+            'delfolder': self.handle_delfolder,
+            'gnfolders': self.handle_gnfolders,
+            'getnamefolders': self.handle_getnamefolders,
+            'gnfiles': self.handle_gnfiles,
+            'getnamefiles': self.handle_getnamefiles,
+            'lstree': self.handle_lstree,
+            'getslog': self.handle_getslog,
+            'startlog': self.handle_startlog,
+            'getflog': self.handle_getflog,
+            'imustream': self.handle_imustream,
+            'statuspush': self.handle_statuspush,
+        }
+
+    def handle(self, line: str) -> List[str]:
+        command, _, arg = line.partition(':')
+        self.received[command] = self.received.get(command, 0) + 1
+
+        handler = self.handlers.get(command)
+        if handler is None:
+            return []
+
+        return handler(arg)
+
+    #
+    #
+    #
+
+    def imu(self):
+        return [round(self.random.uniform(-2, 2), 2) for _ in range(6)]
+
+    def imudata(self):
+        return 'imudata:' + ','.join(str(i) for i in self.imu())
+
+    def handle_info(self, arg):
+        now = datetime.now().strftime('%H,%M,%S,%d,%m,%y')
+        return [f'info:{self.battery},{now},' + ','.join(str(i) for i in self.imu())]
+
+    def handle_imustream(self, arg):
+        if 'stream' not in self.features:
+            return []
+
+        self.stream_rate = int(arg.split(',')[0])
+        self.stream_due = 0.0
+        return [f'imustream:{self.stream_rate}']
+
+    def stream(self, elapsed: float) -> List[str]:
+        """ The samples taken in the last `elapsed` seconds, batched in one line """
+        if self.stream_rate <= 0:
+            return []
+
+        self.stream_due += elapsed * self.stream_rate
+        count = int(self.stream_due)
+        self.stream_due -= count
+        if count == 0:
+            return []
+
+        samples = []
+        for _ in range(count):
+            self.stream_millis += 1000 // self.stream_rate
+            samples.append(f'{self.stream_millis},' + ','.join(str(i) for i in self.imu()))
+
+        return ['imus:' + ';'.join(samples)]
+
+    def handle_statuspush(self, arg):
+        if 'status' not in self.features:
+            return []
+
+        self.push_interval = int(arg.split(',')[0])
+        self.push_due = 0.0
+        return [f'statuspush:{self.push_interval}']
+
+    def push(self, elapsed: float) -> List[str]:
+        """ The status, once the push interval passed or as soon as the battery level changed """
+        if self.push_interval <= 0:
+            return []
+
+        self.push_due -= elapsed
+        if self.push_due > 0 and self.battery == self.pushed_battery:
+            return []
+
+        self.push_due = self.push_interval / 1000
+        self.pushed_battery = self.battery
+        return self.handle_info('')
+
+    def handle_synctime(self, arg):
+        return [f'time:{arg}']
+
+    def handle_setsettings(self, arg):
+        split = arg.split(',')
+        self.settings = (int(split[0]), int(split[1]))
+        return ['setsettings:ok']
+
+    def handle_alarm_get(self, arg):
+        values = ','.join(f'{1 if a.enabled else 0},{a.hour},{a.minute},{a.duration}' for a in self.alarms)
+        return [f'alarm:all,{values}']
+
+    def handle_alarm_set(self, arg):
+        split = [int(i) for i in arg.split(',')]
+        self.alarms = [Alarm(split[i * 4 + 1], split[i * 4 + 2], split[i * 4 + 3], split[i * 4] == 1)
+                       for i in range(12)]
+        return ['alarmSET:OK']
+
+    def handle_delfolder(self, arg):
+        folder = arg.split(',')[0]
+        if self.tree.pop(folder, False) is False:
+            return ['delfolder:fail,*']
+
+        return ['delfolder:ok,*']
+
+    def handle_gnfolders(self, arg):
+        self.folder_cursor = 0
+        return [f'gnfolders:ok,{len(self.tree)}']
+
+    def handle_getnamefolders(self, arg):
+        names = list(self.tree)
+        if self.folder_cursor >= len(names):
+            return []
+
+        index = self.folder_cursor
+        self.folder_cursor += 1
+        return [f'namefolder:ok,{index},{names[index]}']
+
+    def handle_gnfiles(self, arg):
+        self.file_folder = arg.split(',')[0]
+        self.file_cursor = 0
+        return [f'gnfiles:ok,{len(self.tree.get(self.file_folder, {}))}']
+
+    def handle_getnamefiles(self, arg):
+        names = list(self.tree.get(self.file_folder, {}))
+        if self.file_cursor >= len(names):
+            return []
+
+        index = self.file_cursor
+        self.file_cursor += 1
+        return [f'namefiles:ok,{index},{names[index]}']
+
+    def handle_lstree(self, arg):
+        if 'batch' not in self.features:
+            return []
+
+        lines = [f'tree:{folder},{len(files)}' + ''.join(f',{file}' for file in files) for folder, files in self.tree.items()]
+        return lines + [f'treeend:{len(self.tree)}']
+
+    def log_content(self, folder: str, file: str) -> str:
+        files = self.tree[folder]
+        if files[file] is None:
+            rows = ['millis,ax,ay,az,gx,gy,gz']
+            size = len(rows[0]) + 1
+            millis = 0
+            while size < self.log_size:
+                row = f'{millis},' + ','.join(f'{i:.2f}' for i in self.imu())
+                rows.append(row)
+                size += len(row) + 1
+                millis += 10
+
+            files[file] = ('\n'.join(rows) + '\n')[:self.log_size]
+
+        return files[file]
+
+    def handle_getslog(self, arg):
+        _, folder, file = arg.split('/')
+        if folder not in self.tree or file not in self.tree[folder]:
+            return ['getslog:0,*']
+
+        self.log = self.log_content(folder, file)
+        self.log_stream = self.log.replace('\n', '~')
+        self.log_offset = 0
+        return [f'getslog:{len(self.log)},*']
+
+    def chunk(self, offset: int, seq: int = None) -> str:
+        # Each chunk is framed with a 4 char trailer: ',' + chunk sequence number (2 hex digits) + '*'
+        if seq is None:
+            seq = offset // self.chunk_size
+
+        payload = self.log_stream[offset:offset + self.chunk_size]
+        return f'getflog:{payload},{seq & 0xff:02x}*'
+
+    def handle_startlog(self, arg):
+        split = arg.split(',')
+
+        self.log_window = int(split[0]) if 'window' in self.features and split[0].isdigit() else 1
+        if 'offset' in self.features and len(split) > 2 and split[1].isdigit():
+            self.log_offset = min(int(split[1]), len(self.log))
+
+        if 'zlib' in self.features and len(split) > 3 and split[2] == 'zlib':
+            # A deflate stream of the rest of the log, base64 encoded to keep the text framing
+            self.log_stream = base64.b64encode(zlib.compress(self.log[self.log_offset:].encode())).decode()
+            self.log_offset = 0
+
+        self.log_sent = 0
+        self.log_acked = 0
+
+        if self.log_window > 1:
+            return self.send_window()
+
+        return self.handle_getflog(arg)
+
+    def handle_getflog(self, arg):
+        if self.log is None:
+            return []
+
+        split = arg.split(',')
+        if self.log_window > 1 and split[0] == 'ack':
+            # Cumulative ack: the latest chunk sent whose sequence number matches
+            seq = int(split[1], 16)
+            self.log_acked = max(self.log_acked, self.log_sent - 1 - (self.log_sent - 1 - seq) % 256 + 1)
+            return self.send_window()
+
+        if self.log_offset >= len(self.log_stream):
+            self.log = None
+            return ['endlog']
+
+        return [self.next_chunk()]
+
+    def next_chunk(self) -> str:
+        line = self.chunk(self.log_offset, self.log_sent)
+        self.log_offset += self.chunk_size
+        self.log_sent += 1
+        return line
+
+    def send_window(self):
+        lines = []
+        while self.log_offset < len(self.log_stream) and self.log_sent - self.log_acked < self.log_window:
+            lines.append(self.next_chunk())
+
+        if self.log_offset >= len(self.log_stream):
+            self.log = None
+            lines.append('endlog')
+
+        return lines
+
+
+class SimulatedBackend:
+    """
+    A fleet of simulated loggers behind a common link profile. `scanner_class`
+    and `client_class` stand in for `BleakScanner` and `BleakClient`.
+    """
+
+    def __init__(self, loggers: List[SimulatedLogger], link: LinkProfile = None):
+        self.loggers = {logger.address: logger for logger in loggers}
+        self.link = link or LinkProfile()
+
+    @property
+    def scanner_class(self):
+        return functools.partial(SimulatedBleakScanner, self)
+
+    @property
+    def client_class(self):
+        return functools.partial(SimulatedBleakClient, self)
+
+
+class SimulatedBleakScanner:
+    def __init__(self, backend: SimulatedBackend, detection_callback=None, filters=None, **kwargs):
+        self.backend = backend
+        self.detection_callback = detection_callback
+        # As the BlueZ backend, only 'UUIDs' is applied
+        self.filters = filters or {}
+        self.random = random.Random(0)
+        self.task = None
+
+    async def _advertise(self):
+        uuids = [uuid.lower() for uuid in self.filters.get('UUIDs', [])]
+
+        # Loggers keep advertising while the scan runs, with a slightly different RSSI every time
+        while True:
+            for logger in self.backend.loggers.values():
+                await asyncio.sleep(self.backend.link.advertise_interval)
+
+                if len(uuids) > 0 and UART_SERVICE_UUID not in uuids:
+                    continue
+
+                rssi = logger.rssi + self.random.randint(-3, 3)
+                device = BLEDevice(logger.address, logger.name, rssi=rssi)
+                adv = AdvertisementData(local_name=logger.name, service_uuids=[UART_SERVICE_UUID])
+
+                result = self.detection_callback(device, adv)
+                if asyncio.iscoroutine(result):
+                    await result
+
+    async def start(self):
+        if self.detection_callback is not None:
+            self.task = asyncio.get_event_loop().create_task(self._advertise())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+
+
+class SimulatedCharacteristic:
+    def __init__(self, uuid: str, properties: List[str]):
+        self.uuid = uuid
+        self.properties = properties
+
+
+class SimulatedServices:
+    def __init__(self, characteristics: List[SimulatedCharacteristic]):
+        self.characteristics = {char.uuid: char for char in characteristics}
+
+    def get_characteristic(self, specifier) -> Optional[SimulatedCharacteristic]:
+        return self.characteristics.get(str(specifier).lower())
+
+
+class SimulatedBleakClient:
+    def __init__(self, backend: SimulatedBackend, address_or_ble_device, disconnected_callback=None, **kwargs):
+        self.backend = backend
+        self.link = backend.link
+        self.address = getattr(address_or_ble_device, 'address', address_or_ble_device)
+        self.disconnected_callback = disconnected_callback
+
+        self.logger: Optional[SimulatedLogger] = None
+        self.notify_callback = None
+
+        self.rx_buffer = b''
+        self.rx_lines = 0
+        self.tx_queue: Optional[asyncio.Queue] = None
+        self.tx_task = None
+        self.stream_task = None
+
+        self.bytes_written = 0
+        self.writes = 0
+        self.notified = 0
+
+    @property
+    def is_connected(self) -> bool:
+        return self.logger is not None
+
+    @property
+    def mtu_size(self) -> int:
+        return self.link.mtu
+
+    async def connect(self, **kwargs) -> bool:
+        if self.address not in self.backend.loggers:
+            raise BleakError(f'Device with address {self.address} was not found.')
+
+        await asyncio.sleep(self.link.connect_time)
+
+        self.logger = self.backend.loggers[self.address]
+        self.logger.log = None
+        self.logger.stream_rate = 0
+        self.notified = 0
+        self.tx_queue = asyncio.Queue()
+        self.tx_task = asyncio.get_event_loop().create_task(self._transmit())
+        self.stream_task = asyncio.get_event_loop().create_task(self._stream())
+        return True
+
+    async def disconnect(self) -> bool:
+        if self.logger is None:
+            return True
+
+        self.logger = None
+        self.tx_task.cancel()
+        self.tx_task = None
+        self.stream_task.cancel()
+        self.stream_task = None
+
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+        return True
+
+    async def get_services(self, **kwargs) -> SimulatedServices:
+        properties = ['read', 'write', 'notify']
+        if self.link.write_without_response:
+            properties.append('write-without-response')
+
+        return SimulatedServices([SimulatedCharacteristic(UART_CHAR_UUID, properties)])
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        self.notify_callback = callback
+
+    async def stop_notify(self, char_specifier):
+        self.notify_callback = None
+
+    async def write_gatt_char(self, char_specifier, data, response: bool = False):
+        if self.logger is None:
+            raise BleakError('Not connected')
+
+        if len(data) > self.link.mtu - 3:
+            raise BleakError(f'Write of {len(data)} bytes exceeds ATT MTU {self.link.mtu}')
+
+        if not response and not self.link.write_without_response:
+            raise BleakError('Characteristic does not support write without response')
+
+        self.writes += 1
+        self.bytes_written += len(data)
+
+        await asyncio.sleep(len(data) / self.link.bandwidth)
+        if response:
+            await asyncio.sleep(self.link.latency * 2)
+
+        asyncio.get_event_loop().call_later(self.link.latency, self._receive, bytes(data))
+
+    #
+    #
+    #
+
+    def _receive(self, data: bytes):
+        if self.logger is None:
+            return
+
+        self.rx_buffer += data
+        while b'\n' in self.rx_buffer:
+            line, self.rx_buffer = self.rx_buffer.split(b'\n', 1)
+
+            self.rx_lines += 1
+            if self.link.ignore_every > 0 and self.rx_lines % self.link.ignore_every == 0:
+                continue
+
+            for response in self.logger.handle(line.decode()):
+                self.tx_queue.put_nowait((response + '\n').encode())
+
+    async def _transmit(self):
+        loop = asyncio.get_event_loop()
+        size = self.link.mtu - 3
+
+        while True:
+            data = await self.tx_queue.get()
+
+            for i in range(0, len(data), size):
+                packet = bytearray(data[i:i + size])
+                await asyncio.sleep(len(packet) / self.link.bandwidth)
+                loop.call_later(self.link.latency, self._notify, packet)
+
+    async def _stream(self):
+        loop = asyncio.get_event_loop()
+        last = loop.time()
+
+        while True:
+            await asyncio.sleep(STREAM_INTERVAL)
+
+            now = loop.time()
+            for line in self.logger.stream(now - last) + self.logger.push(now - last):
+                self.tx_queue.put_nowait((line + '\n').encode())
+
+            last = now
+
+    def _notify(self, packet: bytearray):
+        if self.logger is None or self.notify_callback is None:
+            return
+
+        self.notified += len(packet)
+        if 0 < self.link.drop_after < self.notified:
+            asyncio.ensure_future(self.disconnect())
+            return
+
+        result = self.notify_callback(UART_CHAR_HANDLE, packet)
+        if asyncio.iscoroutine(result):
+            asyncio.ensure_future(result)
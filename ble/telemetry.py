@@ -0,0 +1,77 @@
+import numpy as np
+
+# Samples kept per device, a minute at 500 Hz
+TELEMETRY_CAPACITY = 30000
+# Time in seconds, then acceleration and gyroscope X, Y and Z
+TELEMETRY_COLUMNS = 7
+
+
+class RingBuffer:
+    """
+    Fixed-size buffer of the latest IMU samples, one row per sample. Once
+    full, new samples overwrite the oldest ones, so memory never grows.
+    """
+
+    def __init__(self, capacity: int = TELEMETRY_CAPACITY, columns: int = TELEMETRY_COLUMNS):
+        self.data = np.zeros((capacity, columns))
+        self.capacity = capacity
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+    def extend(self, rows: np.ndarray):
+        rows = rows[-self.capacity:]
+        end = self.head + len(rows)
+
+        if end <= self.capacity:
+            self.data[self.head:end] = rows
+        else:
+            split = self.capacity - self.head
+            self.data[self.head:] = rows[:split]
+            self.data[:end - self.capacity] = rows[split:]
+
+        self.head = end % self.capacity
+        self.count = min(self.count + len(rows), self.capacity)
+
+    def append(self, row):
+        self.data[self.head] = row
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def extend_text(self, text: str) -> int:
+        """ Add samples sent as 'millis,ax,ay,az,gx,gy,gz' rows separated by ';' """
+        rows = np.array(text.replace(';', ',').split(','), dtype=np.float64).reshape(-1, self.data.shape[1])
+        rows[:, 0] /= 1000
+        self.extend(rows)
+        return len(rows)
+
+    def last(self) -> np.ndarray:
+        return self.data[self.head - 1]
+
+    def ordered(self) -> np.ndarray:
+        """ The samples from oldest to newest """
+        if self.count < self.capacity:
+            return self.data[:self.count]
+
+        return np.concatenate((self.data[self.head:], self.data[:self.head]))
+
+    def decimate(self, buckets: int):
+        """
+        The samples reduced to at most `buckets` time buckets, keeping the
+        minimum and maximum of each column per bucket so peaks stay visible.
+        Returns the bucket start times and the minimums and maximums.
+        """
+        samples = self.ordered()
+        if len(samples) <= buckets:
+            return samples[:, 0], samples[:, 1:], samples[:, 1:]
+
+        edges = np.linspace(0, len(samples), buckets, endpoint=False).astype(np.intp)
+        return (samples[edges, 0],
+                np.minimum.reduceat(samples[:, 1:], edges, axis=0),
+                np.maximum.reduceat(samples[:, 1:], edges, axis=0))
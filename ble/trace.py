@@ -0,0 +1,226 @@
+"""
+Protocol traces: every notification received and every command sent on a
+connection, timestamped, so a field session can be replayed through the
+parser without the logger.
+
+A trace file is MAGIC, a version byte, the length of a JSON header as an
+unsigned short and the header itself, followed by one ENTRY per packet:
+microseconds since the previous packet, then the payload length with TX
+in its top bit, then the payload. Six bytes of overhead per packet, as
+notifications are often only 20 bytes.
+"""
+
+import asyncio
+import json
+import os
+import struct
+import time
+from typing import Callable, Dict, Iterator, Tuple
+
+MAGIC = b'BBQTRACE'
+VERSION = 1
+ENTRY = struct.Struct('<IH')
+
+RX = 0
+TX = 0x8000
+
+TRACE_EXTENSION = '.bbqtrace'
+
+
+class TraceRecorder:
+    """ Appends the packets of one connection to a trace file """
+
+    def __init__(self, path: str, header: Dict[str, object]):
+        self.started = time.monotonic()
+        self.elapsed = 0
+        self.entries = 0
+
+        encoded = json.dumps(header).encode()
+        self.file, self.path = create_unique(path)
+        self.file.write(MAGIC + bytes([VERSION]) + struct.pack('<H', len(encoded)) + encoded)
+
+    def record(self, direction: int, data: bytes):
+        if self.file is None:
+            return
+
+        elapsed = int((time.monotonic() - self.started) * 1000000)
+        delta = min(elapsed - self.elapsed, 0xFFFFFFFF)
+        self.elapsed = self.elapsed + delta
+
+        self.file.write(ENTRY.pack(delta, direction | min(len(data), 0x7FFF)))
+        self.file.write(data[:0x7FFF])
+        self.entries = self.entries + 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class TraceReader:
+    """
+    Packets of a trace file, as (seconds since the trace started, RX or TX,
+    payload) tuples.
+
+        reader = TraceReader(path)
+        for elapsed, direction, data in reader: ...
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a protocol trace")
+
+            version = f.read(1)[0]
+            if version != VERSION:
+                raise ValueError(f"{path} is a version {version} trace, only version {VERSION} is supported")
+
+            length, = struct.unpack('<H', f.read(2))
+            self.header = json.loads(f.read(length))
+            self.offset = f.tell()
+
+    def __iter__(self) -> Iterator[Tuple[float, int, bytes]]:
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            elapsed = 0
+
+            while True:
+                entry = f.read(ENTRY.size)
+                if len(entry) < ENTRY.size:
+                    # Traces of a crashed session may end in a partial entry
+                    return
+
+                delta, length = ENTRY.unpack(entry)
+                elapsed = elapsed + delta
+
+                data = f.read(length & 0x7FFF)
+                if len(data) < length & 0x7FFF:
+                    return
+
+                yield elapsed / 1000000, length & TX, data
+
+
+def trace_path(directory: str, address: str) -> str:
+    return os.path.join(directory, f"{address.replace(':', '')}_{time.strftime('%Y%m%d_%H%M%S')}{TRACE_EXTENSION}")
+
+
+def create_unique(path: str):
+    """ Open a new file at `path`, or at `path` numbered, as reconnects may start within the same second """
+    base, extension = os.path.splitext(path)
+    n = 1
+
+    while True:
+        try:
+            return open(path, 'xb'), path
+        except FileExistsError:
+            n = n + 1
+            path = f"{base}_{n}{extension}"
+
+
+#
+#
+#
+
+# What the host did when it sent these commands, redone on replay so the
+# replies find the device in the state they were received in, by command name
+HOST_COMMANDS: Dict[str, Callable] = {}
+
+
+def host_command(command: str):
+    def decorator(func):
+        HOST_COMMANDS[command] = func
+        return func
+
+    return decorator
+
+
+@host_command('getslog')
+def replay_getslog(device, args: str, directory: str):
+    _, folder, file = args.split('/', 2)
+    device.download_file(folder, file, os.path.join(directory, device.file_name(folder, file)))
+
+
+@host_command('lstree')
+@host_command('gnfolders')
+def replay_list(device, args: str, directory: str):
+    return asyncio.ensure_future(device.list_folders())
+
+
+@host_command('imustream')
+def replay_imustream(device, args: str, directory: str):
+    rate = int(args.split(',')[0])
+    if rate > 0:
+        device.start_telemetry(rate)
+    else:
+        device.stop_telemetry()
+
+
+async def replay(path: str, device, directory: str, realtime: bool = False) -> Dict[str, float]:
+    """
+    Feed the notifications of a trace through `device.handle_rx`, at full
+    speed or as fast as they were received. The device must not be
+    connected, so nothing is sent. Downloads are written to `directory`.
+    """
+    loop = asyncio.get_event_loop()
+    reader = TraceReader(path)
+
+    updates = 0
+
+    def updated(_):
+        nonlocal updates
+        updates = updates + 1
+
+    device.updated.connect(updated)
+
+    received = 0
+    handled = 0.0
+    duration = 0.0
+    tasks = []
+
+    start = loop.time()
+    for elapsed, direction, data in reader:
+        duration = elapsed
+
+        if realtime:
+            await asyncio.sleep(max(start + elapsed - loop.time(), 0))
+
+        if direction == TX:
+            command, _, args = data.decode(errors='replace').rstrip('\n').partition(':')
+            redo = HOST_COMMANDS.get(command)
+            if redo is not None:
+                task = redo(device, args, directory)
+                if task is not None:
+                    tasks.append(task)
+                    # Started before the replies to it are fed
+                    await asyncio.sleep(0)
+
+            continue
+
+        received = received + len(data)
+        before = time.perf_counter()
+        await device.handle_rx(0, bytearray(data))
+        handled = handled + time.perf_counter() - before
+
+    replayed = loop.time() - start
+
+    # Downloads left open by the end of the trace, and listings it never finished
+    if device.download_file_stream is not None:
+        await asyncio.gather(device.download_file_stream.close(), return_exceptions=True)
+
+    for task in tasks:
+        task.cancel()
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+    device.updated.disconnect(updated)
+
+    return {
+        'trace duration (s)': duration,
+        'replay (s)': replayed,
+        'notifications (KiB)': received / 1024,
+        'lines': device.metrics.counters['lines_received'],
+        'updates': updates,
+        'handle_rx (s)': handled,
+        'handle_rx per line (us)': handled / max(device.metrics.counters['lines_received'], 1) * 1000000,
+    }
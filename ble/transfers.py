@@ -0,0 +1,187 @@
+import asyncio
+import json
+import os
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional
+
+import ble
+from ble import Device
+from ble.signals import Signal
+from utils import data_path
+
+# Reconnect attempts of an interrupted transfer before leaving it queued for later
+TRANSFER_RETRIES = 5
+# Seconds to wait before the first reconnect, doubled after every failed attempt
+TRANSFER_BACKOFF = 1.0
+# Seconds to wait for the connection handshake
+TRANSFER_READY_TIMEOUT = 30.0
+
+
+@dataclass
+class Transfer:
+    address: str
+    folder: str
+    file: str
+    path: str
+    size: int = 0
+    written: int = 0
+    attempts: int = 0
+    # queued, active, done or failed
+    state: str = 'queued'
+    error: str = ''
+
+    @property
+    def pending(self):
+        return self.state in ('queued', 'active')
+
+
+class TransferManager:
+    """
+    Queue of file downloads per device, saved to disk so interrupted
+    transfers survive reconnects and restarts. A transfer resumes from the
+    bytes already written when the firmware supports the 'offset' feature,
+    and starts over otherwise.
+    """
+
+    changed = Signal()
+
+    def __init__(self, path: str = None):
+        self.path = path or data_path('transfers.json')
+        self.transfers: List[Transfer] = []
+        self.workers: Dict[str, asyncio.Task] = {}
+
+        self.retries = TRANSFER_RETRIES
+        self.backoff = TRANSFER_BACKOFF
+        self.reconnects = 0
+        # Also export finished downloads to memory-mappable columns
+        self.export = False
+
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.transfers = [Transfer(**i) for i in json.load(f)]
+        except FileNotFoundError:
+            self.transfers = []
+        except Exception as ex:
+            print(f"Could not load transfers: {ex}")
+            self.transfers = []
+
+        for transfer in self.transfers:
+            if transfer.state == 'active':
+                transfer.state = 'queued'
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump([asdict(i) for i in self.transfers], f, indent=1)
+
+        os.replace(self.path + '.tmp', self.path)
+        self.changed.emit()
+
+    def clear_finished(self):
+        self.transfers = [i for i in self.transfers if i.pending]
+        self.save()
+
+    #
+    #
+    #
+
+    def pending(self, address: str) -> List[Transfer]:
+        return [i for i in self.transfers if i.address == address and i.pending]
+
+    def enqueue(self, device: Device, folder: str, file: str, path: str) -> Transfer:
+        transfer = next((i for i in self.pending(device.ble.address) if i.folder == folder and i.file == file), None)
+        if transfer is None:
+            transfer = Transfer(device.ble.address, folder, file, path)
+            self.transfers.append(transfer)
+        else:
+            transfer.path = path
+
+        self.save()
+        return transfer
+
+    def start(self, device: Device) -> Optional[asyncio.Task]:
+        """ Work through the queue of the device, unless it is already being worked on """
+        address = device.ble.address
+
+        worker = self.workers.get(address)
+        if worker is not None and not worker.done():
+            return worker
+
+        if len(self.pending(address)) == 0:
+            return None
+
+        worker = asyncio.get_event_loop().create_task(self._work(device))
+        self.workers[address] = worker
+        return worker
+
+    async def _work(self, device: Device):
+        retries = 0
+        acquired = False
+
+        try:
+            while True:
+                pending = self.pending(device.ble.address)
+                if len(pending) == 0:
+                    return
+
+                transfer = pending[0]
+
+                try:
+                    if not acquired:
+                        await device.acquire()
+                        acquired = True
+
+                    await asyncio.wait_for(device.ready.wait(), TRANSFER_READY_TIMEOUT)
+                    await self._transfer(device, transfer)
+                    retries = 0
+                except (ble.BleakError, asyncio.TimeoutError) as ex:
+                    # The link dropped, reconnect and resume where it stopped
+                    transfer.state = 'queued'
+                    self.save()
+
+                    if acquired:
+                        acquired = False
+                        await device.release()
+
+                    retries = retries + 1
+                    self.reconnects = self.reconnects + 1
+                    if retries > self.retries:
+                        print(f"{device.name}: leaving {transfer.file} queued: {ex}")
+                        return
+
+                    await asyncio.sleep(self.backoff * 2 ** (retries - 1))
+                except Exception as ex:
+                    transfer.state = 'failed'
+                    transfer.error = str(ex)
+                    self.save()
+        finally:
+            if acquired:
+                await device.release()
+
+    async def _transfer(self, device: Device, transfer: Transfer):
+        if not device.running:
+            raise ble.BleakError(f"Device {device.name} is not connected")
+
+        transfer.state = 'active'
+        transfer.attempts = transfer.attempts + 1
+        self.save()
+
+        try:
+            # Resume from what an earlier attempt left on disk
+            await device.fetch_file(transfer.folder, transfer.file, transfer.path, resume=transfer.attempts > 1)
+        finally:
+            transfer.size = device.download_size
+            transfer.written = device.download_written
+
+        transfer.state = 'done'
+        self.save()
+
+        if self.export:
+            from utils.export import export_columns
+
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, export_columns, transfer.path)
+            except Exception as ex:
+                print(f"Could not export {transfer.path}: {ex}")
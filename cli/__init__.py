@@ -0,0 +1,234 @@
+"""
+Headless commands, for collecting logs on machines without a display:
+
+    python main.py harvest --all --out DIR
+    python -m cli harvest --address AA:BB:CC:DD:EE:FF --out DIR --metrics metrics.prom
+    python main.py replay AABBCCDDEEFF_20211017_101500.bbqtrace
+
+Nothing here imports Qt.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+COMMANDS: Dict[str, Callable] = {}
+
+
+def command(name: str):
+    def decorator(func):
+        COMMANDS[name] = func
+        return func
+
+    return decorator
+
+
+def report(message: str):
+    # stdout carries the protocol output, progress goes to stderr
+    print(message, file=sys.stderr, flush=True)
+
+
+def create_profiler():
+    from ble import Device
+    from utils.profiling import Profiler
+    from utils.writer import FileWriter
+
+    profiler = Profiler()
+    profiler.instrument(Device, 'handle_rx')
+    profiler.instrument(Device, 'receive_cmd', nested=True)
+    profiler.watch_downloads(FileWriter, 'write')
+    profiler.watch_held_acks(Device, '_ack_when_drained')
+    return profiler
+
+
+def create_scanner(options):
+    from ble import Scanner
+
+    if options.simulate <= 0:
+        return Scanner()
+
+    from ble.listings import ListingCache
+    from ble.registry import KnownDevices
+    from ble.simulator import SimulatedBackend, SimulatedLogger
+
+    # Simulated loggers stay out of the listings and known devices of real ones
+    backend = SimulatedBackend([SimulatedLogger(f'AA:00:00:00:00:{i + 1:02X}', f'BBQ{i + 1}', seed=i)
+                                for i in range(options.simulate)])
+    directory = tempfile.mkdtemp()
+    return Scanner(backend.scanner_class, backend.client_class, ListingCache(os.path.join(directory, 'listings.json')),
+                   KnownDevices(os.path.join(directory, 'devices.json')))
+
+
+def write_metrics(options, devices):
+    from ble.metrics import to_json, to_prometheus
+
+    # Prometheus text when asked for, or when the file is named like it
+    prometheus = options.metrics_format == 'prometheus' or (options.metrics_format is None and
+                                                            options.metrics.endswith('.prom'))
+    export = to_prometheus if prometheus else to_json
+    text = export((device.metric_labels(), device.metrics) for device in devices)
+
+    if options.metrics == '-':
+        sys.__stdout__.write(text)
+        sys.__stdout__.flush()
+        return
+
+    with open(options.metrics, 'w') as f:
+        f.write(text)
+
+
+@command('harvest')
+async def harvest(options) -> int:
+    from ble import MAX_CONNECTIONS, SCAN_TIME
+    from ble.fleet import FleetDownload
+
+    scan_time = options.scan_time if options.scan_time is not None else SCAN_TIME
+    targets = {address.upper() for address in options.address}
+    scanner = create_scanner(options)
+
+    if options.trace is not None:
+        os.makedirs(options.trace, exist_ok=True)
+        scanner.trace_directory = options.trace
+
+    if not options.all:
+        known = scanner.add_known_devices()
+        if options.known:
+            targets = {device.ble.address.upper() for device in known}
+
+    # Known loggers are connected to by address, only unknown targets need a scan
+    if options.all or not targets <= {address.upper() for address in scanner.devices}:
+        report(f"Scanning for {scan_time:g} s")
+        # Targets stop the scan as soon as they are all found
+        await scanner.scan_ble_devices(scan_time, None if options.all else targets)
+
+    devices = [device for address, device in scanner.devices.items() if options.all or address.upper() in targets]
+    missing = targets - {device.ble.address.upper() for device in devices}
+    for address in missing:
+        report(f"{address} - not found")
+
+    if len(devices) == 0:
+        report("No loggers to harvest")
+        return 1
+
+    os.makedirs(options.out, exist_ok=True)
+
+    job = FleetDownload(devices, options.out, options.max_connections or MAX_CONNECTIONS, device_directories=True)
+    job.progress.connect(lambda device: report(job.describe(device)))
+
+    start = time.perf_counter()
+    await job.run()
+    elapsed = time.perf_counter() - start
+
+    files = sum(job.files_done.values())
+    report(f"Harvested {files} files, {job.bytes_total / 1024:.1f} KiB from {len(devices) - len(job.errors)}/"
+           f"{len(devices)} loggers in {elapsed:.1f} s")
+
+    if options.metrics is not None:
+        write_metrics(options, devices)
+
+    return 1 if len(job.errors) > 0 or len(missing) > 0 else 0
+
+
+@command('replay')
+async def replay(options) -> int:
+    from bleak.backends.device import BLEDevice
+
+    from ble import Device, Scanner
+    from ble.listings import ListingCache
+    from ble.registry import KnownDevices
+    from ble.trace import TraceReader, replay as replay_trace
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Nothing replayed ends up in the listings and known devices of real loggers
+        scanner = Scanner(listings=ListingCache(os.path.join(directory, 'listings.json')),
+                          known=KnownDevices(os.path.join(directory, 'devices.json')))
+        out = options.out or directory
+        os.makedirs(out, exist_ok=True)
+
+        for path in options.traces:
+            try:
+                header = TraceReader(path).header
+            except (OSError, ValueError) as ex:
+                report(f"{path}: {ex}")
+                return 1
+
+            device = Device(scanner, BLEDevice(header['address'], header['name']))
+
+            results = await replay_trace(path, device, out, options.realtime)
+
+            report(f"{path} - {header['name']} ({header['address']})")
+            for name, value in results.items():
+                report(f"  {name:<28} {value:.3f}" if isinstance(value, float) else f"  {name:<28} {value}")
+
+    return 0
+
+
+@command('devices')
+async def devices(options) -> int:
+    from ble.registry import KnownDevices
+
+    for address, name in KnownDevices().names().items():
+        print(f"{address}\t{name}", file=sys.__stdout__)
+
+    return 0
+
+
+def create_parser() -> argparse.ArgumentParser:
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--verbose', action='store_true', help='print the protocol output')
+    common.add_argument('--profile', action='store_true', help='report where the time went at exit, see bbq-profile.txt')
+
+    parser = argparse.ArgumentParser(prog='bbq-manager', description='Headless BBQ logger management.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    harvest_parser = commands.add_parser('harvest', parents=[common], help='download every log of many loggers at once')
+    targets = harvest_parser.add_mutually_exclusive_group(required=True)
+    targets.add_argument('--all', action='store_true', help='every logger found while scanning')
+    targets.add_argument('--known', action='store_true', help='every logger seen on earlier runs, without scanning')
+    targets.add_argument('--address', action='append', default=[], help='address of a logger, can be repeated')
+    harvest_parser.add_argument('--out', required=True, help='directory to download to, one subdirectory per logger')
+    # Defaults are filled in by the command, the protocol core is not loaded just to parse arguments
+    harvest_parser.add_argument('--scan-time', type=float, help='seconds spent scanning (default: 5)')
+    harvest_parser.add_argument('--max-connections', type=int, help='loggers downloaded from at once (default: 4)')
+    harvest_parser.add_argument('--metrics', help='write link metrics of every logger to this file, - for stdout')
+    harvest_parser.add_argument('--metrics-format', choices=['json', 'prometheus'],
+                                help='format of --metrics (default: prometheus for .prom files, json otherwise)')
+    harvest_parser.add_argument('--trace', help='record a protocol trace of every connection to this directory')
+    harvest_parser.add_argument('--simulate', type=int, default=0, help=argparse.SUPPRESS)
+
+    replay_parser = commands.add_parser('replay', parents=[common], help='feed protocol traces through the parser')
+    replay_parser.add_argument('traces', nargs='+', help='trace files recorded with --trace')
+    replay_parser.add_argument('--realtime', action='store_true', help='as fast as recorded, not at full speed')
+    replay_parser.add_argument('--out', help='directory to write replayed downloads to (default: discarded)')
+
+    commands.add_parser('devices', parents=[common], help='list the loggers seen on earlier runs')
+
+    return parser
+
+
+def main(argv: List[str] = None) -> int:
+    options = create_parser().parse_args(argv)
+    profiler = create_profiler() if options.profile else None
+
+    async def run():
+        if profiler is not None:
+            profiler.start()
+
+        try:
+            return await COMMANDS[options.command](options)
+        finally:
+            if profiler is not None:
+                profiler.stop()
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if options.verbose else devnull):
+        code = asyncio.run(run())
+
+    if profiler is not None:
+        profiler.write_report()
+
+    return code
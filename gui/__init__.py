@@ -1,4 +1,5 @@
 import asyncio
+import os
 from asyncio import Task
 from datetime import datetime
 from math import floor
@@ -10,15 +11,41 @@ from PySide2.QtWidgets import (QPushButton,
                                QGroupBox, QLabel, QSpacerItem, QSizePolicy, QProgressBar, QTimeEdit, QLineEdit,
                                QListWidgetItem, QAbstractItemView, QTableWidget, QHeaderView, QTableWidgetItem,
                                QCheckBox, QTreeView, QFileIconProvider, QMenu, QErrorMessage, QMessageBox, QFileDialog)
-from PySide2.QtCore import Qt, Slot, QTime, QDir
+from PySide2.QtCore import Qt, Slot, Signal, QTime, QDir, QTimer, QEvent, QPoint
 from qasync import asyncSlot
 
 from ble import Device, Scanner
+from ble.fleet import FleetDownload
+from ble.pool import ConnectionPool
+from ble.transfers import TransferManager
+from gui.diagnostics import DiagnosticsPanel
+from gui.plot import TelemetryPlot
+from utils import human_readable_size
 from utils.dialogs import QAsyncMessageBox, QAsyncFileDialog
 
+# Maximum repaints per second of the selected device, updates in between are coalesced
+REFRESH_RATE = 30
+# Milliseconds between re-sorts of the device list by RSSI
+SORT_INTERVAL = 500
+
+
+class DeviceListItem(QListWidgetItem):
+    """ Device list entry, ordered strongest signal first """
+
+    def __lt__(self, other):
+        return self.device.rssi > other.device.rssi
+
 
 class MainWidget(QWidget):
-    ble_device: Device
+    ble_device: Device = None
+    refresh_timer: QTimer
+
+    # Emitted once, when the window is first drawn
+    first_paint = Signal()
+    painted = False
+
+    # Recently selected devices, kept connected
+    pool: ConnectionPool
 
     device_list: QListWidget
     device_list_frame: QFrame
@@ -28,6 +55,7 @@ class MainWidget(QWidget):
 
     time_sync_button: QPushButton
     scan_button: QPushButton
+    download_all_button: QPushButton
 
     time_value: QLabel
 
@@ -61,6 +89,23 @@ class MainWidget(QWidget):
         QWidget.__init__(self)
 
         self.ble_scanner = ble_scanner
+        self.pool = ConnectionPool(ble_scanner.pool_size, ble_scanner.pool_idle_timeout)
+        self.pool.opened.connect(lambda device: device.updated.connect(self.update_device))
+        self.pool.closed.connect(lambda device: device.updated.disconnect(self.update_device))
+        self.transfers = TransferManager()
+
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(1000 // REFRESH_RATE)
+        self.refresh_timer.timeout.connect(self.refresh_device)
+
+        # The device list is kept ordered by signal strength, re-sorted at most this often
+        self.sort_timer = QTimer(self)
+        self.sort_timer.setSingleShot(True)
+        self.sort_timer.setInterval(SORT_INTERVAL)
+        self.sort_timer.timeout.connect(self.sort_devices)
+
+        self.diagnostics = DiagnosticsPanel(self)
 
         self.create_device_list()
         self.create_empty_device()
@@ -88,15 +133,34 @@ class MainWidget(QWidget):
 
         #
         ble_scanner.device_found.connect(self.add_device)
+        ble_scanner.device_seen.connect(self.device_seen)
         # ble_scanner.device_disconnected.connect(self.remove_device)
 
     #
     #
     #
 
+    def paintEvent(self, event):
+        QWidget.paintEvent(self, event)
+
+        if not self.painted:
+            self.painted = True
+            self.first_paint.emit()
+
+    def changeEvent(self, event):
+        QWidget.changeEvent(self, event)
+
+        if event.type() == QEvent.WindowStateChange:
+            self.update_status_visible()
+
+    def update_status_visible(self):
+        # The device on screen is polled faster, unless the window is minimised
+        if self.ble_device is not None:
+            self.ble_device.status_visible = not self.isMinimized()
+
     @Slot(Device)
     def add_device(self, device: Device):
-        item = QListWidgetItem(self.device_list)
+        item = DeviceListItem(self.device_list)
         device.list_widget = item
         device.list_widget_label = QLabel(device.name)
 
@@ -104,22 +168,60 @@ class MainWidget(QWidget):
         self.device_list.addItem(item)
         self.device_list.setItemWidget(item, device.list_widget_label)
 
+        if not self.sort_timer.isActive():
+            self.sort_timer.start()
+
+        # Resume downloads left unfinished by a previous session
+        self.transfers.start(device)
+
     @Slot(Device)
-    def update_device(self, device: Device):
-        self.ble_device = device
+    def device_seen(self, device: Device):
+        if device.list_widget is None:
+            return
 
-        if device.name:
+        if device.list_widget_label.text() == device.ble.address:
             device.list_widget_label.setText(device.name)
 
-        self.set_battery(device.battery)
-        self.set_device_firmware(device.firmware)
-        self.set_device_label(device.name)
+        if not self.sort_timer.isActive():
+            self.sort_timer.start()
+
+    @Slot()
+    def sort_devices(self):
+        self.device_list.sortItems()
+
+    @Slot(Device)
+    def update_device(self, device: Device):
+        if device is not self.ble_device:
+            return
+
+        if not self.refresh_timer.isActive():
+            self.refresh_timer.start()
+
+    @Slot()
+    def refresh_device(self):
+        device = self.ble_device
+        if device is None:
+            return
+
+        if device.battery_changed:
+            device.battery_changed = False
+            self.set_battery(device.battery)
+
+        if device.firmware_changed:
+            device.firmware_changed = False
+            self.set_device_firmware(device.firmware)
 
         if device.dtime_changed:
             device.dtime_changed = False
             self.set_device_time(device.dtime)
 
-        self.set_imu(device.imu_acceleration, device.imu_gyro)
+        if device.imu_changed:
+            device.imu_changed = False
+            self.set_imu(device.imu_acceleration, device.imu_gyro)
+
+        if device.telemetry_changed:
+            device.telemetry_changed = False
+            self.telemetry_plot.set_telemetry(device.telemetry)
 
         if device.settings_changed:
             device.settings_changed = False
@@ -133,46 +235,70 @@ class MainWidget(QWidget):
             device.folders_changed = False
             self.set_files(device.folders)
 
-        self.files_refresh_button.setDisabled(device.folders_disabled)
-
-        self.files_text.setText(device.folders_message)
-        self.files_progress.setValue(device.folders_progress * 100)
+        if device.folders_status_changed:
+            device.folders_status_changed = False
+            self.files_refresh_button.setDisabled(device.folders_disabled)
+            self.files_text.setText(device.folders_message)
+            self.files_progress.setValue(int(device.folders_progress * 100))
 
     @asyncSlot(QListWidgetItem, QListWidgetItem)
     async def select_device(self, current, previous):
         self.empty_device.setVisible(True)
         self.content_frame.setVisible(False)
 
-        loop = asyncio.get_event_loop()
-
-        if previous:
-            self.empty_device_label.setText('Disconnecting from previous device...')
-            if previous.device.runtask is not None:
-                previous.device.runtask.cancel()
+        if self.ble_device is not None:
+            # Only the device on screen streams telemetry
+            self.ble_device.stop_telemetry()
+            self.ble_device.status_visible = False
 
-                previous.device.runtask = None
-
-            previous.device.updated.disconnect()
-            await previous.device.disconnect_device()
+        self.ble_device = None
+        self.telemetry_checkbox.setChecked(False)
+        self.pool.deactivate()
 
         if current:
-            self.empty_device_label.setText('Connecting to selected device...')
-            current.device.updated.connect(self.update_device)
-
-            try:
-                await current.device.connect_device()
+            device = current.device
 
-                current.device.runtask = loop.create_task(current.device.run())
+            if device not in self.pool or not device.running:
+                self.empty_device_label.setText('Connecting to selected device...')
 
-                self.update_device(current.device)
-                self.empty_device.setVisible(False)
-                self.content_frame.setVisible(True)
+            try:
+                # Only connects when the device is not pooled already
+                await self.pool.activate(device)
             except Exception as ex:
-                self.remove_device(current.device)
+                self.remove_device(device)
                 self.empty_device_label.setText('Could not connect to device.')
+                return
+
+            if self.device_list.currentItem() is not current:
+                # Another device was selected while connecting
+                if self.pool.active is device:
+                    self.pool.deactivate()
+                return
+
+            self.ble_device = device
+            self.diagnostics.set_device(device)
+            self.update_status_visible()
+            self.set_device_label(device.name)
+            device.mark_changed()
+            self.refresh_device()
+            self.transfers.start(device)
+            self.empty_device.setVisible(False)
+            self.content_frame.setVisible(True)
+
+    @Slot(bool)
+    def toggle_telemetry(self, checked: bool):
+        self.telemetry_plot.setVisible(checked)
+
+        if self.ble_device is None:
+            return
+
+        if checked:
+            self.ble_device.start_telemetry()
+        else:
+            self.ble_device.stop_telemetry()
 
     def remove_device(self, device: Device):
-        self.ble_scanner.devices.pop(device.client.address)
+        self.ble_scanner.devices.pop(device.ble.address, None)
 
         if device.list_widget:
             self.device_list.takeItem(self.device_list.row(device.list_widget))
@@ -181,6 +307,24 @@ class MainWidget(QWidget):
             self.empty_device.setVisible(True)
             self.content_frame.setVisible(False)
 
+    @Slot(QPoint)
+    def device_menu(self, pos):
+        item = self.device_list.itemAt(pos)
+        if item is None:
+            return
+
+        menu = QMenu()
+        forget_action = menu.addAction("&Forget")
+
+        if menu.exec_(self.device_list.viewport().mapToGlobal(pos)) == forget_action:
+            asyncio.ensure_future(self.forget_device(item.device))
+
+    async def forget_device(self, device: Device):
+        """ Drop the device from the list and from the known devices, until it is seen advertising again """
+        self.ble_scanner.known.remove(device.ble.address)
+        self.remove_device(device)
+        await self.pool.remove(device)
+
     def set_battery(self, value: int):
         valuef = value / 100.0
         self.battery_value.setValue(max((valuef - 3.3) / (4.2 - 3.3), 0) * 100.0)
@@ -289,9 +433,41 @@ class MainWidget(QWidget):
     @asyncSlot()
     async def refresh_files(self):
         if self.ble_device and not self.ble_device.folders_pending:
-            self.ble_device.folders_pending = True
-            self.files_root.removeRows(0, self.files_root.rowCount())
-            self.ble_device.send_cmd("gnfolders:*")
+            try:
+                await self.ble_device.list_folders()
+            except Exception as ex:
+                print(ex)
+
+    @asyncSlot()
+    async def download_all(self):
+        devices = list(self.ble_scanner.devices.values())
+        if len(devices) == 0:
+            return
+
+        target_path = QFileDialog.getExistingDirectory(None, 'Select destination folder')
+        if not target_path:
+            return
+
+        # Advertised names need not be unique, each logger gets a directory of its own
+        job = FleetDownload(devices, target_path, self.ble_scanner.max_connections, device_directories=True)
+        job.progress.connect(lambda device: device.list_widget_label.setText(job.describe(device)))
+
+        self.download_all_button.setEnabled(False)
+        try:
+            await job.run()
+        finally:
+            self.download_all_button.setEnabled(True)
+
+            # The progress was shown in place of the names
+            for device in devices:
+                if device.list_widget is not None:
+                    device.list_widget_label.setText(device.name)
+
+        message = f"Downloaded {human_readable_size(job.bytes_total)} from {len(devices) - len(job.errors)} devices."
+        if len(job.errors) > 0:
+            message += "\nFailed: " + ", ".join(device.name for device in job.errors)
+
+        await QAsyncMessageBox.information(self, "Download all", message)
 
     @asyncSlot()
     async def update_alarms(self):
@@ -336,6 +512,8 @@ class MainWidget(QWidget):
         self.device_list = QListWidget()
         self.device_list.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
         self.device_list.currentItemChanged.connect(self.select_device)
+        self.device_list.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.device_list.customContextMenuRequested.connect(self.device_menu)
 
         layout.addWidget(self.device_list)
 
@@ -345,6 +523,10 @@ class MainWidget(QWidget):
 
         layout.addWidget(self.scan_button)
 
+        self.download_all_button = QPushButton("Download all devices")
+        self.download_all_button.clicked.connect(self.download_all)
+        layout.addWidget(self.download_all_button)
+
         self.device_list_frame.setLayout(layout)
 
     def create_content_frame(self):
@@ -428,6 +610,14 @@ class MainWidget(QWidget):
 
             layout_box.addItem(grid_box)
 
+            self.telemetry_checkbox = QCheckBox("Live")
+            self.telemetry_checkbox.toggled.connect(self.toggle_telemetry)
+            layout_box.addWidget(self.telemetry_checkbox)
+
+            self.telemetry_plot = TelemetryPlot()
+            self.telemetry_plot.setVisible(False)
+            layout_box.addWidget(self.telemetry_plot)
+
             reset_button = QPushButton("Reset")
             reset_button.clicked.connect(
                 lambda: asyncio.run_coroutine_threadsafe(self.reset_imu(), asyncio.get_event_loop()))
@@ -493,6 +683,10 @@ class MainWidget(QWidget):
             actions_box = QGroupBox("Misc")
             layout_box = QVBoxLayout()
 
+            diagnostics_button = QPushButton("Diagnostics")
+            diagnostics_button.clicked.connect(lambda: (self.diagnostics.show(), self.diagnostics.raise_()))
+            layout_box.addWidget(diagnostics_button)
+
             layout_box.addStretch()
 
             self.device_label = QLabel()
@@ -602,6 +796,10 @@ class MainWidget(QWidget):
             self.files_refresh_button.clicked.connect(self.refresh_files)
             layout_box.addWidget(self.files_refresh_button)
 
+            export_checkbox = QCheckBox("Export columns (.npy) after download")
+            export_checkbox.toggled.connect(lambda checked: setattr(self.transfers, 'export', checked))
+            layout_box.addWidget(export_checkbox)
+
             footer_grid = QGridLayout()
             self.files_progress = QProgressBar()
             footer_grid.addWidget(self.files_progress, 0, 0)
@@ -636,17 +834,29 @@ class MainWidget(QWidget):
                         self.ble_device.delete_folder(it.text())
                     elif action == download_action:
                         target_path = QFileDialog.getExistingDirectory(None, 'Select destination folder')
-                        self.ble_device.download_folder(it.text(), target_path)
+                        if not target_path:
+                            return
+
+                        folder = next(i for i in self.ble_device.folders if i.name == it.text())
+                        for file in folder.children:
+                            self.transfers.enqueue(self.ble_device, folder.name, file.name,
+                                                   os.path.join(target_path, self.ble_device.file_name(folder.name, file.name)))
+
+                        self.transfers.start(self.ble_device)
                 elif it.data() == 3:
                     download_action = menu.addAction("&Download")
                     action = menu.exec_(tree_view.viewport().mapToGlobal(pos))
                     if action == download_action:
                         folder = it.parent().text()
                         target_path, extension = QFileDialog.getSaveFileName(None, 'Select destination file', f'{self.ble_device.name}_{folder}_{it.text()}.csv', 'CSV files (*.csv)')
+                        if not target_path:
+                            return
+
                         if not target_path.endswith('.csv'):
                             target_path += '.csv'
 
-                        self.ble_device.download_file(folder, it.text(), target_path)
+                        self.transfers.enqueue(self.ble_device, folder, it.text(), target_path)
+                        self.transfers.start(self.ble_device)
 
             tree_view.customContextMenuRequested.connect(menuClick)
 
@@ -0,0 +1,74 @@
+from PySide2.QtCore import Qt, QTimer
+from PySide2.QtWidgets import (QWidget, QVBoxLayout, QTableWidget, QTableWidgetItem, QHeaderView, QAbstractItemView,
+                               QPushButton, QApplication)
+
+from ble.metrics import to_json, to_prometheus
+
+REFRESH_INTERVAL = 1000
+
+
+class DiagnosticsPanel(QWidget):
+    """
+    Link metrics of the selected device in a window of its own, refreshed
+    every second while it is open. They can be copied as JSON or
+    Prometheus text to compare loggers, firmware versions and adapters.
+    """
+
+    def __init__(self, parent=None):
+        QWidget.__init__(self, parent, Qt.Window)
+        self.setWindowTitle("Diagnostics")
+        self.resize(420, 480)
+
+        self.device = None
+
+        layout = QVBoxLayout()
+
+        self.table = QTableWidget(0, 2)
+        self.table.setHorizontalHeaderLabels(["Metric", "Value"])
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        layout.addWidget(self.table)
+
+        copy_json_button = QPushButton("Copy as JSON")
+        copy_json_button.clicked.connect(lambda: self.copy(to_json))
+        layout.addWidget(copy_json_button)
+
+        copy_prometheus_button = QPushButton("Copy as Prometheus text")
+        copy_prometheus_button.clicked.connect(lambda: self.copy(to_prometheus))
+        layout.addWidget(copy_prometheus_button)
+
+        self.setLayout(layout)
+
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(REFRESH_INTERVAL)
+        self.refresh_timer.timeout.connect(self.refresh)
+
+    def set_device(self, device):
+        self.device = device
+        self.setWindowTitle(f"Diagnostics - {device.name}" if device is not None else "Diagnostics")
+        self.refresh()
+
+    def showEvent(self, event):
+        QWidget.showEvent(self, event)
+        self.refresh()
+        self.refresh_timer.start()
+
+    def hideEvent(self, event):
+        QWidget.hideEvent(self, event)
+        self.refresh_timer.stop()
+
+    def refresh(self):
+        if not self.isVisible():
+            return
+
+        rows = self.device.metrics.summary() if self.device is not None else []
+        self.table.setRowCount(len(rows))
+
+        for i, (name, value) in enumerate(rows):
+            self.table.setItem(i, 0, QTableWidgetItem(name))
+            self.table.setItem(i, 1, QTableWidgetItem(value))
+
+    def copy(self, export):
+        if self.device is not None:
+            QApplication.clipboard().setText(export([(self.device.metric_labels(), self.device.metrics)]))
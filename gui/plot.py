@@ -0,0 +1,59 @@
+from PySide2.QtCore import Qt, QPointF
+from PySide2.QtGui import QPainter, QPen, QPolygonF
+from PySide2.QtWidgets import QWidget
+
+
+class TelemetryPlot(QWidget):
+    """
+    Live plot of a device telemetry buffer, acceleration on top and
+    gyroscope below. Samples are decimated to the widget width before
+    drawing, so the cost of a repaint does not depend on the sample rate.
+    """
+
+    COLORS = [Qt.red, Qt.darkGreen, Qt.blue]
+    PANES = ["Acceleration", "Gyroscope"]
+
+    def __init__(self, parent=None):
+        QWidget.__init__(self, parent)
+
+        # RingBuffer of the device shown
+        self.telemetry = None
+        self.setMinimumHeight(160)
+
+    def set_telemetry(self, telemetry):
+        self.telemetry = telemetry
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), Qt.white)
+
+        if self.telemetry is None or len(self.telemetry) < 2:
+            return
+
+        # Only needed once there is something to draw, the telemetry loaded it already
+        import numpy as np
+
+        # Each bucket is drawn as a vertical min-max segment, two points per bucket
+        times, low, high = self.telemetry.decimate(max(self.width() // 2, 1))
+        span = max(times[-1] - times[0], 1e-6)
+        xs = np.repeat((times - times[0]) / span * (self.width() - 1), 2)
+
+        height = self.height() / len(self.PANES)
+        for pane, name in enumerate(self.PANES):
+            columns = slice(pane * 3, pane * 3 + 3)
+            bottom = low[:, columns].min()
+            top = high[:, columns].max()
+            scale = (height - 4) / max(top - bottom, 1e-6)
+
+            for i, color in enumerate(self.COLORS):
+                ys = np.empty(len(xs))
+                ys[0::2] = low[:, pane * 3 + i]
+                ys[1::2] = high[:, pane * 3 + i]
+                ys = (pane + 1) * height - 2 - (ys - bottom) * scale
+
+                painter.setPen(QPen(color))
+                painter.drawPolyline(QPolygonF([QPointF(x, y) for x, y in zip(xs.tolist(), ys.tolist())]))
+
+            painter.setPen(QPen(Qt.black))
+            painter.drawText(4, int(pane * height) + 14, name)
@@ -7,23 +7,18 @@ An example showing how to write a simple program using the Nordic Semiconductor
 
 """
 
+import time
+
+# Startup is timed from here, before anything heavier than the interpreter is loaded
+STARTED = time.perf_counter()
+
 import asyncio
 import functools
 import os
 import sys
 
-import qasync
-from PySide2.QtCore import QSize
-from PySide2.QtGui import QIcon
-from PySide2.QtWidgets import QApplication
-
-
-#
-#
-#
-
-from ble import Scanner
-from gui import MainWidget
+from cli import COMMANDS
+from utils.startup import StartupTimer
 
 
 def resource_path(relative_path):
@@ -38,29 +33,94 @@ def resource_path(relative_path):
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        # Headless, without loading Qt at all
+        from cli import main as cli_main
+        sys.exit(cli_main(sys.argv[1:]))
+
+    # --startup-profile reports the time spent in each phase until the window is painted
+    timer = StartupTimer(STARTED, '--startup-profile' in sys.argv)
+
+    import qasync
+    from PySide2.QtCore import QSize, Qt
+    from PySide2.QtGui import QIcon
+    from PySide2.QtWidgets import QApplication
+    timer.mark('import qt')
+
+    from ble import Scanner, load_bleak
+    timer.mark('import ble')
+
+    from gui import MainWidget
+    timer.mark('import gui')
+
+    profiler = None
+    if '--profile' in sys.argv:
+        # Instrumented before anything is connected to the methods timed
+        from cli import create_profiler
+        profiler = create_profiler()
+        profiler.instrument(MainWidget, 'refresh_device')
+        profiler.instrument(MainWidget, 'update_device', 'set_files', nested=True)
+
     app = QApplication(sys.argv)
     loop = qasync.QEventLoop(app)
     asyncio.set_event_loop(loop)
+    timer.mark('create application')
 
     ble_scanner = Scanner()
 
+    if '--trace' in sys.argv[:-1]:
+        # --trace DIR records a protocol trace of every connection, for `main.py replay`
+        ble_scanner.trace_directory = sys.argv[sys.argv.index('--trace') + 1]
+        os.makedirs(ble_scanner.trace_directory, exist_ok=True)
+
     widget = MainWidget(ble_scanner)
     widget.setWindowTitle("BBQ Manager")
-
-    icon = QIcon()
-    for size in [16, 24, 32, 48, 64, 96, 128, 256, 512]:
-        icon.addFile(resource_path(f'icons/{size}.png'), QSize(size, size))
-
-    widget.setWindowIcon(icon)
+    timer.mark('create window')
 
     widget.resize(1000, 600)
     widget.show()
+    timer.mark('show window')
+
+    def painted():
+        timer.mark('first paint')
 
-    loop.create_task(ble_scanner.scan_ble_devices())
+        # Nothing below is needed to draw the window, so it waits until it is on screen
+        icon = QIcon()
+        for size in [16, 24, 32, 48, 64, 96, 128, 256, 512]:
+            icon.addFile(resource_path(f'icons/{size}.png'), QSize(size, size))
+
+        widget.setWindowIcon(icon)
+        timer.mark('load icons')
+
+        # Probes the platform for a BLE backend, bluetoothctl on Linux
+        load_bleak()
+        timer.mark('import bleak')
+
+        # Loggers from earlier runs are listed right away, the scan only adds new ones
+        ble_scanner.add_known_devices()
+        timer.mark('add known devices')
+
+        loop.create_task(ble_scanner.scan_ble_devices())
+        timer.report()
+
+        if '--exit-after-startup' in sys.argv:
+            app.quit()
+
+    # Queued, so it runs once the paint returned and the frame is on screen, not within it
+    widget.first_paint.connect(painted, Qt.QueuedConnection)
 
     with loop:
+        if profiler is not None:
+            loop.call_soon(profiler.start)
+
         loop.run_forever()
 
+        if profiler is not None:
+            profiler.stop()
+
+    if profiler is not None:
+        profiler.write_report()
+
     print("Goodbye")
     sys.exit(0)
 
@@ -1,6 +1,10 @@
+import os
 from dataclasses import dataclass
 from typing import List
 
+# Where state kept between runs is stored, e.g. the transfer queue
+DATA_DIRECTORY = os.path.join(os.path.expanduser('~'), '.bbq-manager')
+
 
 @dataclass
 class Alarm:
@@ -25,3 +29,6 @@ def human_readable_size(size, decimal_places=2):
         size /= 1024.0
     return f"{size:.{decimal_places}f} {unit}"
 
+def data_path(name):
+    os.makedirs(DATA_DIRECTORY, exist_ok=True)
+    return os.path.join(DATA_DIRECTORY, name)
@@ -0,0 +1,138 @@
+import itertools
+import json
+import os
+from typing import List
+
+import numpy as np
+
+# CSV rows parsed at a time, memory use is bounded by this regardless of the file size
+EXPORT_CHUNK_ROWS = 64 * 1024
+# Bytes reserved for each .npy header, rewritten with the final shape once all rows are in
+NPY_HEADER_SIZE = 128
+
+
+def export_path(csv_path: str) -> str:
+    """ Directory the columns of `csv_path` are exported to """
+    return os.path.splitext(csv_path)[0]
+
+
+def npy_header(dtype: np.dtype, rows: int) -> bytes:
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (rows,)})
+    # Magic, version 1.0 and header length, then the header padded with spaces and ending in a newline
+    header = header.encode('latin1').ljust(NPY_HEADER_SIZE - 10 - 1) + b'\n'
+    return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header
+
+
+def column_dtype(values: np.ndarray) -> np.dtype:
+    if np.all(np.mod(values, 1) == 0) and np.all(np.abs(values) < 2 ** 53):
+        return np.dtype('<i8')
+
+    return np.dtype('<f8')
+
+
+def widen(stream, rows: int):
+    """ Rewrite the first `rows` int64 values of a column file as float64, in place as both take 8 bytes """
+    for start in range(0, rows, EXPORT_CHUNK_ROWS):
+        count = min(rows - start, EXPORT_CHUNK_ROWS)
+
+        stream.seek(NPY_HEADER_SIZE + start * 8)
+        values = np.frombuffer(stream.read(count * 8), dtype='<i8')
+        stream.seek(NPY_HEADER_SIZE + start * 8)
+        stream.write(values.astype('<f8').tobytes())
+
+    stream.seek(0, os.SEEK_END)
+
+
+def parse_rows(lines: List[str], columns: int) -> np.ndarray:
+    try:
+        return np.loadtxt(lines, delimiter=',', dtype=np.float64, ndmin=2).reshape(-1, columns)
+    except ValueError:
+        # A truncated or corrupted row, keep the ones that parse
+        rows = []
+        for line in lines:
+            try:
+                row = [float(i) for i in line.split(',')]
+            except ValueError:
+                continue
+
+            if len(row) == columns:
+                rows.append(row)
+
+        return np.array(rows, dtype=np.float64).reshape(-1, columns)
+
+
+def export_columns(csv_path: str, target_path: str = None, chunk_rows: int = EXPORT_CHUNK_ROWS) -> str:
+    """
+    Convert a downloaded log into one .npy file per column plus a
+    schema.json, so it can be memory-mapped instead of parsed again.
+    The CSV is streamed `chunk_rows` at a time. Columns holding only whole
+    numbers are stored as int64, the rest as float64; an int64 column is
+    widened to float64 once a fraction turns up. Returns the path of the
+    schema.
+    """
+    target_path = target_path or export_path(csv_path)
+    os.makedirs(target_path, exist_ok=True)
+
+    with open(csv_path, newline='') as f:
+        names = f.readline().strip().split(',')
+        files = [os.path.join(target_path, f'{name}.npy') for name in names]
+        streams = [open(path + '.tmp', 'w+b') for path in files]
+        dtypes = [np.dtype('<i8') for _ in names]
+        rows = 0
+
+        try:
+            for stream in streams:
+                stream.write(b'\0' * NPY_HEADER_SIZE)
+
+            while True:
+                lines = [line for line in itertools.islice(f, chunk_rows) if line.strip()]
+                if len(lines) == 0:
+                    break
+
+                chunk = parse_rows(lines, len(names))
+                if len(chunk) == 0:
+                    continue
+
+                for i, stream in enumerate(streams):
+                    if dtypes[i].kind == 'i' and column_dtype(chunk[:, i]).kind == 'f':
+                        widen(stream, rows)
+                        dtypes[i] = np.dtype('<f8')
+
+                    chunk[:, i].astype(dtypes[i]).tofile(stream)
+
+                rows = rows + len(chunk)
+
+            if rows == 0:
+                dtypes = [np.dtype('<f8') for _ in names]
+
+            for stream, dtype in zip(streams, dtypes):
+                stream.seek(0)
+                stream.write(npy_header(dtype, rows))
+        finally:
+            for stream in streams:
+                stream.close()
+
+    for path in files:
+        os.replace(path + '.tmp', path)
+
+    schema = {
+        'source': os.path.basename(csv_path),
+        'rows': rows,
+        'columns': [{'name': name, 'dtype': dtype.str, 'file': os.path.basename(path)}
+                    for name, dtype, path in zip(names, dtypes, files)],
+    }
+
+    schema_path = os.path.join(target_path, 'schema.json')
+    with open(schema_path, 'w') as f:
+        json.dump(schema, f, indent=1)
+
+    return schema_path
+
+
+def load_columns(target_path: str) -> dict:
+    """ Memory-map the columns of an export, by name """
+    with open(os.path.join(target_path, 'schema.json')) as f:
+        schema = json.load(f)
+
+    return {column['name']: np.load(os.path.join(target_path, column['file']), mmap_mode='r')
+            for column in schema['columns']}
@@ -0,0 +1,247 @@
+import asyncio
+import cProfile
+import functools
+import inspect
+import io
+import pstats
+import sys
+import time
+from typing import Dict, Set
+
+# Callbacks holding the event loop longer than this are reported, in seconds
+LAG_THRESHOLD = 0.05
+# Seconds between checks of the event loop lag
+LAG_INTERVAL = 0.01
+
+REPORT_PATH = 'bbq-profile.txt'
+STATS_PATH = 'bbq-profile.prof'
+
+
+class StageTimer:
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed: float):
+        self.calls = self.calls + 1
+        self.total = self.total + elapsed
+        self.max = max(self.max, elapsed)
+
+
+class Profiler:
+    """
+    --profile: a cProfile session around the event loop, timers around the
+    hot paths given to `instrument`, and a monitor of callbacks blocking
+    the loop. `report` tells which stage limited the download speed.
+
+        profiler = Profiler()
+        profiler.instrument(Device, 'handle_rx')
+        profiler.instrument(Device, 'receive_cmd', nested=True)
+        profiler.start()
+        ...
+        profiler.stop()
+        profiler.write_report()
+    """
+
+    def __init__(self, lag_threshold: float = LAG_THRESHOLD):
+        self.lag_threshold = lag_threshold
+        self.profile = cProfile.Profile()
+        self.stages: Dict[str, StageTimer] = {}
+        # Stages only ever called from within other stages, their time is counted there already
+        self.nested: Set[str] = set()
+
+        # Loop stalls seen by the monitor, and the callbacks that ran too long, by name
+        self.stalls = StageTimer()
+        self.slow_callbacks: Dict[str, StageTimer] = {}
+
+        # Bytes written by downloads, and the seconds they were written in
+        self.download_bytes = 0
+        self.download_seconds: Set[int] = set()
+        # Acks held back until the disk caught up
+        self.held_acks = StageTimer()
+
+        self.started = None
+        self.stopped = None
+        self.monitor: asyncio.Task = None
+        self.handle_run = None
+
+    def instrument(self, cls, *names: str, nested: bool = False):
+        """ Time every call of the methods `names` of `cls`, on every instance """
+        for name in names:
+            stage = f"{cls.__name__}.{name}"
+            setattr(cls, name, self._timed(stage, getattr(cls, name)))
+
+            if nested:
+                self.nested.add(stage)
+
+    def watch_downloads(self, cls, name: str):
+        """ Count the bytes returned by the writes of downloads """
+        write = getattr(cls, name)
+
+        @functools.wraps(write)
+        def counted(*args, **kwargs):
+            written = write(*args, **kwargs)
+            self.download_bytes = self.download_bytes + written
+            self.download_seconds.add(int(time.perf_counter()))
+            return written
+
+        stage = f"{cls.__name__}.{name}"
+        setattr(cls, name, self._timed(stage, counted))
+        # Called while handling a notification
+        self.nested.add(stage)
+
+    def watch_held_acks(self, cls, name: str):
+        """ Time the coroutine that holds acks back while the disk is behind """
+        setattr(cls, name, self._timed(None, getattr(cls, name), self.held_acks))
+
+    def _timed(self, stage, func, timer: StageTimer = None):
+        timer = timer or self.stages.setdefault(stage, StageTimer())
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    timer.add(time.perf_counter() - start)
+        else:
+            @functools.wraps(func)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    timer.add(time.perf_counter() - start)
+
+        return timed
+
+    #
+    #
+    #
+
+    def start(self):
+        """ Start profiling, from within the running event loop """
+        self.started = time.perf_counter()
+
+        # Every callback of the loop goes through Handle._run, qasync included
+        self.handle_run = asyncio.events.Handle._run
+        handle_run = self.handle_run
+
+        def run(handle):
+            start = time.perf_counter()
+            handle_run(handle)
+            elapsed = time.perf_counter() - start
+
+            if elapsed > self.lag_threshold:
+                self.slow_callbacks.setdefault(describe(handle), StageTimer()).add(elapsed)
+
+        asyncio.events.Handle._run = run
+
+        self.monitor = asyncio.get_event_loop().create_task(self._monitor())
+        self.profile.enable()
+
+    def stop(self):
+        if self.started is None or self.stopped is not None:
+            return
+
+        self.profile.disable()
+        self.stopped = time.perf_counter()
+
+        asyncio.events.Handle._run = self.handle_run
+        if self.monitor is not None:
+            self.monitor.cancel()
+
+    async def _monitor(self):
+        loop = asyncio.get_event_loop()
+
+        # Anything blocking the loop, Qt slots and paints included, delays this wake up
+        while True:
+            before = loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            lag = loop.time() - before - LAG_INTERVAL
+
+            if lag > self.lag_threshold:
+                self.stalls.add(lag)
+
+    #
+    #
+    #
+
+    def bottleneck(self) -> str:
+        download_time = len(self.download_seconds)
+        if self.download_bytes == 0:
+            return "No downloads while profiling."
+
+        rate = self.download_bytes / 1024 / download_time
+        header = f"{self.download_bytes / 1024:.1f} KiB downloaded in {download_time} s with data, {rate:.1f} KiB/s."
+
+        if self.held_acks.total > 0.1 * download_time:
+            return (f"{header}\nLimited by disk writes: acks were held back {self.held_acks.calls} times for "
+                    f"{self.held_acks.total:.1f} s while the writer caught up.")
+
+        busy = sum(timer.total for stage, timer in self.stages.items() if stage not in self.nested)
+        if busy > 0.5 * download_time:
+            slowest = max(self.stages, key=lambda stage: self.stages[stage].total)
+            return (f"{header}\nLimited by host processing: {busy / download_time:.0%} of the download time was "
+                    f"spent in the timed stages, most in {slowest}.")
+
+        if self.stalls.total > 0.1 * download_time:
+            slowest = max(self.slow_callbacks, key=lambda name: self.slow_callbacks[name].total, default="Qt")
+            return (f"{header}\nLimited by event loop stalls: {self.stalls.total:.1f} s blocked, "
+                    f"mostly by {slowest}.")
+
+        return (f"{header}\nLimited by the BLE link: the host was idle {1 - busy / download_time:.0%} of the "
+                f"download time, waiting for notifications.")
+
+    def summary(self) -> str:
+        out = io.StringIO()
+        elapsed = (self.stopped or time.perf_counter()) - (self.started or time.perf_counter())
+
+        print(f"Profile of {elapsed:.1f} s", file=out)
+        print(file=out)
+        print(f"{'Stage':<32} {'calls':>9} {'total (s)':>10} {'mean (us)':>10} {'max (ms)':>9}", file=out)
+        for stage, timer in sorted(self.stages.items(), key=lambda i: -i[1].total):
+            print(f"{stage:<32} {timer.calls:>9} {timer.total:>10.3f} "
+                  f"{timer.total / max(timer.calls, 1) * 1000000:>10.1f} {timer.max * 1000:>9.1f}", file=out)
+
+        print(file=out)
+        print(f"Event loop stalls over {self.lag_threshold * 1000:g} ms: {self.stalls.calls}, "
+              f"{self.stalls.total:.2f} s in total, longest {self.stalls.max * 1000:.0f} ms", file=out)
+        for name, timer in sorted(self.slow_callbacks.items(), key=lambda i: -i[1].total)[:10]:
+            print(f"  {name:<50} {timer.calls:>5}x, longest {timer.max * 1000:.0f} ms", file=out)
+
+        print(file=out)
+        print(self.bottleneck(), file=out)
+        return out.getvalue()
+
+    def report(self, top: int = 25) -> str:
+        out = io.StringIO()
+        print(self.summary(), file=out)
+        print(f"Top {top} functions by cumulative time, timings inflated by cProfile:", file=out)
+        pstats.Stats(self.profile, stream=out).sort_stats('cumulative').print_stats(top)
+
+        return out.getvalue()
+
+    def write_report(self, path: str = REPORT_PATH, stats_path: str = STATS_PATH):
+        self.stop()
+
+        with open(path, 'w') as f:
+            f.write(self.report())
+
+        self.profile.dump_stats(stats_path)
+
+        print(self.summary(), file=sys.stderr)
+        print(f"Profile written to {path}, cProfile stats to {stats_path}", file=sys.stderr, flush=True)
+
+
+def describe(handle) -> str:
+    callback = handle._callback
+    owner = getattr(callback, '__self__', None)
+
+    if isinstance(owner, asyncio.Task):
+        coro = owner.get_coro()
+        return getattr(coro, '__qualname__', repr(coro))
+
+    return getattr(callback, '__qualname__', repr(callback))
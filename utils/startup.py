@@ -0,0 +1,38 @@
+import sys
+import time
+from typing import List, Tuple
+
+
+class StartupTimer:
+    """
+    Time spent in each phase of the application start, measured from
+    `start`. Phases are reported on stderr when `enabled`, e.g.
+
+        import qt                   182.4 ms
+        first paint                  31.0 ms
+        total                       655.3 ms
+    """
+
+    def __init__(self, start: float = None, enabled: bool = False):
+        self.start = start if start is not None else time.perf_counter()
+        self.last = self.start
+        self.enabled = enabled
+        self.phases: List[Tuple[str, float]] = []
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    @property
+    def total(self) -> float:
+        return self.last - self.start
+
+    def report(self):
+        if not self.enabled:
+            return
+
+        for phase, elapsed in self.phases:
+            print(f"{phase:<24} {elapsed * 1000:8.1f} ms", file=sys.stderr)
+
+        print(f"{'total':<24} {self.total * 1000:8.1f} ms", file=sys.stderr, flush=True)
@@ -0,0 +1,154 @@
+import asyncio
+import os
+import queue
+import threading
+
+# Bytes buffered by the writer thread before they reach the file
+WRITER_BUFFER_SIZE = 1024 * 1024
+# Bytes queued for the writer thread above which the writer is congested
+WRITER_MAX_PENDING = 4 * 1024 * 1024
+
+
+class FileWriter:
+    """
+    Writes a download from a background thread, so the event loop never
+    waits on the disk. `write` only queues the data, `close` flushes,
+    fsyncs and returns a future resolved once the file is complete.
+
+    Log payloads are queued as received, the thread replaces the '~'
+    newline placeholders before writing.
+    """
+
+    def __init__(self, path: str, offset: int = 0, buffer_size: int = WRITER_BUFFER_SIZE,
+                 max_pending: int = WRITER_MAX_PENDING):
+        self.path = path
+        self.offset = offset
+        self.buffer_size = buffer_size
+        self.max_pending = max_pending
+
+        self.loop = asyncio.get_event_loop()
+        self.queue = queue.SimpleQueue()
+        self.condition = threading.Condition()
+        self.pending = 0
+        self.error: Exception = None
+        self.closed = False
+        self.done = self.loop.create_future()
+
+        self.thread = threading.Thread(target=self._run, name=f'writer {os.path.basename(path)}', daemon=True)
+        self.thread.start()
+
+    @property
+    def congested(self) -> bool:
+        return self.pending > self.max_pending
+
+    def write(self, data: str) -> int:
+        if self.error is not None:
+            raise self.error
+
+        with self.condition:
+            self.pending += len(data)
+
+        self.queue.put(data)
+        return len(data)
+
+    def preallocate(self, size: int):
+        """ Reserve `size` bytes on disk up front, where the platform supports it """
+        self.queue.put(size)
+
+    def close(self) -> asyncio.Future:
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+
+        return self.done
+
+    async def drained(self):
+        """ Wait until the pending data is back under half the congestion limit """
+        await self.loop.run_in_executor(None, self._wait_drained)
+
+    #
+    #
+    #
+
+    def _wait_drained(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending <= self.max_pending // 2 or self.error is not None)
+
+    def _resolve(self, error: Exception):
+        if self.done.done():
+            return
+
+        if error is not None:
+            self.done.set_exception(error)
+            # Nobody may be waiting on it, avoid the 'exception never retrieved' warning
+            self.done.exception()
+        else:
+            self.done.set_result(self.path)
+
+    def _run(self):
+        error = None
+
+        try:
+            if self.offset > 0:
+                f = open(self.path, 'r+b', buffering=self.buffer_size)
+                f.truncate(self.offset)
+                f.seek(self.offset)
+            else:
+                f = open(self.path, 'wb', buffering=self.buffer_size)
+
+            with f:
+                while True:
+                    item = self.queue.get()
+
+                    if item is None:
+                        break
+
+                    if isinstance(item, int):
+                        if hasattr(os, 'posix_fallocate') and item > f.tell():
+                            try:
+                                os.posix_fallocate(f.fileno(), f.tell(), item - f.tell())
+                            except OSError:
+                                pass
+
+                        continue
+
+                    f.write(item.replace('~', '\n').encode())
+
+                    with self.condition:
+                        self.pending -= len(item)
+                        self.condition.notify_all()
+
+                # Preallocation may have reserved more than was received
+                f.truncate(f.tell())
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as ex:
+            error = ex
+            self.error = ex
+
+            with self.condition:
+                self.condition.notify_all()
+
+        try:
+            self.loop.call_soon_threadsafe(self._resolve, error)
+        except RuntimeError:
+            # The event loop is already closed
+            pass
+
+
+def written_size(path: str) -> int:
+    """ Size of a download on disk, without the padding preallocation may have left after a crash """
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+
+        while size > 0:
+            block = min(size, 64 * 1024)
+            f.seek(size - block)
+            data = f.read(block).rstrip(b'\0')
+
+            if len(data) > 0:
+                return size - block + len(data)
+
+            size = size - block
+
+        return 0